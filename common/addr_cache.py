@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import collections
+
+import netaddr
+
+
+class ParsedAddress(collections.namedtuple(
+        'ParsedAddress', 'version ip network prefixlen cidr first last')):
+    """An address or network as parsed by netaddr, in immutable form.
+
+    ip, network and cidr are compact strings: the address, the network
+    address and 'ip/prefixlen'.  first and last are the integer values of
+    the first and last address of the network.  A bare address is its
+    own network, with a prefixlen of 32 or 128.
+    """
+
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def contains(self, other):
+        """Whether other lies within this network."""
+        return (self.version == other.version and
+                self.first <= other.first and other.last <= self.last)
+
+    def overlaps(self, other):
+        return (self.version == other.version and
+                self.first <= other.last and other.first <= self.last)
+
+
+class AddressCache(object):
+    """Bounded cache of the parsed form of address and CIDR strings.
+
+    The same subnet CIDRs and port addresses are parsed over and over on
+    every reload; each string is parsed once and its ParsedAddress shared
+    by every caller.  The cache is dropped as a whole once it holds
+    max_size entries.  Strings netaddr cannot parse are not cached, the
+    netaddr error is raised on every lookup.
+    """
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self._networks = {}
+        self._addresses = {}
+
+    def _put(self, entries, key, parsed):
+        if len(entries) >= self.max_size:
+            entries.clear()
+        entries[key] = parsed
+        return parsed
+
+    def network(self, cidr):
+        """Parse cidr like netaddr.IPNetwork, 'ip/prefixlen' or 'ip'."""
+        parsed = self._networks.get(cidr)
+        if parsed is None:
+            net = netaddr.IPNetwork(cidr)
+            parsed = self._put(self._networks, cidr, ParsedAddress(
+                net.version, str(net.ip), str(net.network), net.prefixlen,
+                str(net), net.first, net.last))
+        return parsed
+
+    def address(self, address):
+        """Parse address like netaddr.IPAddress."""
+        parsed = self._addresses.get(address)
+        if parsed is None:
+            ip = netaddr.IPAddress(address)
+            value = int(ip)
+            prefixlen = 32 if ip.version == 4 else 128
+            parsed = self._put(self._addresses, address, ParsedAddress(
+                ip.version, str(ip), str(ip), prefixlen,
+                '%s/%d' % (ip, prefixlen), value, value))
+        return parsed
+
+    def is_ipv6(self, address):
+        """Like netaddr.valid_ipv6, False for anything but IPv6."""
+        try:
+            return self.address(address).version == 6
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            return False
+
+    def __len__(self):
+        return len(self._networks) + len(self._addresses)
+
+
+# shared by the DHCP driver and the interface drivers
+cache = AddressCache()
+network = cache.network
+address = cache.address
+is_ipv6 = cache.is_ipv6
@@ -107,7 +107,45 @@ DHCP_AGENT_OPTS = [
                        "dedicated network. Requires "
                        "enable_isolated_metadata = True")),
     cfg.IntOpt('num_sync_threads', default=4,
-               help=('Number of threads to use during sync process.'))
+               help=('Number of threads to use during sync process. Also '
+                     'bounds how many networks are configured in parallel; '
+                     'work for a single network is always serialized.')),
+    cfg.BoolOpt('async_api', default=False,
+                help=("Return 202 Accepted with a job id instead of waiting "
+                       "for the DHCP driver to finish. Callers can override "
+                       "this per request with the 'async' query parameter.")),
+    cfg.IntOpt('job_history_size', default=1000,
+               help=('Number of most recent jobs whose status is kept for '
+                     'the jobs API.')),
+    cfg.BoolOpt('network_cache_persistence', default=False,
+                help=("Save the agent's network cache to disk so that a "
+                       "restarted agent knows all subnets and ports "
+                       "without the controller sending them again.")),
+    cfg.StrOpt('network_cache_dir', default='$state_path/cache',
+               help=('Directory holding the network cache snapshot and '
+                     'journal.')),
+    cfg.FloatOpt('network_cache_sync_interval', default=1.0,
+                 help=('Seconds between fsyncs of the network cache '
+                       'journal. Changes made since the last fsync are lost '
+                       'if the host crashes.')),
+    cfg.IntOpt('network_cache_snapshot_interval', default=300,
+               help=('Seconds between snapshots of the network cache, '
+                     'after which the journal starts over.')),
+    cfg.IntOpt('network_cache_journal_max_records', default=10000,
+               help=('Take a network cache snapshot early once the journal '
+                     'holds this many records.')),
+    cfg.IntOpt('bulk_network_concurrency', default=8,
+               help=('Number of networks of a bulk network request that are '
+                     'set up at the same time.')),
+    cfg.FloatOpt('dhcp_reload_coalesce_window', default=0.0,
+                 help=('Seconds to wait for more port events on a network '
+                       'before reloading its DHCP server, so a burst of '
+                       'events costs a single reload. 0 disables '
+                       'coalescing.')),
+    cfg.FloatOpt('dhcp_reload_coalesce_max_delay', default=1.0,
+                 help=('Upper bound in seconds on how long a coalesced '
+                       'reload can be postponed by a steady stream of '
+                       'port events.')),
 ]
 
 DHCP_OPTS = [
@@ -135,6 +173,33 @@ DNSMASQ_OPTS = [
         help=('Limit number of leases to prevent a denial-of-service.')),
     cfg.BoolOpt('dhcp_broadcast_reply', default=False,
                 help=("Use broadcast in DHCP replies")),
+    cfg.BoolOpt('dnsmasq_use_hostsdir', default=False,
+                help=('Give dnsmasq one host, addn_hosts and opts file per '
+                      'port in directories it watches, so new ports are '
+                      'picked up without a reload. Only used with dnsmasq '
+                      '2.73 or newer.')),
+    cfg.BoolOpt('dhcp_release_batch', default=False,
+                help=('Release the stale leases of a network with one '
+                      'privileged dhcp_release_batch call instead of one '
+                      'dhcp_release call per lease.')),
+    cfg.StrOpt('dhcp_release_backend', default='native',
+               choices=['native', 'dhcp_release'],
+               help=('How dhcp_release_batch releases leases: native sends '
+                     'the DHCPRELEASE packets itself, dhcp_release runs '
+                     'the dhcp_release binary for each lease.')),
+    cfg.IntOpt('dnsmasq_port_fragment_cache_size', default=100000,
+               help=('Number of ports whose rendered dnsmasq host, '
+                     'addn_hosts, lease and opts lines are kept in memory '
+                     'between reloads. 0 disables the cache.')),
+    cfg.BoolOpt('dnsmasq_share_option_tags', default=False,
+                help=('Write the extra DHCP options of ports with the same '
+                      'options once, under a tag shared by these ports, '
+                      'instead of once per port.')),
+    cfg.StrOpt('dnsmasq_shared_namespace', default='qdhcp-shared',
+               help=('Namespace the SharedDnsmasq driver plugs the DHCP '
+                     'interfaces of all networks into, served by a single '
+                     'dnsmasq. The subnets of these networks must not '
+                     'overlap.')),
 ]
 
 core_cli_opts = [
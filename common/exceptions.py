@@ -45,6 +45,11 @@ class NetworkVxlanPortRangeError(DhcpAgentException):
     message = ("Invalid network VXLAN port range: '%(vxlan_range)s'")
 
 
+class SubnetOverlap(Conflict):
+    message = ("Subnet %(cidr)s of network %(net_id)s overlaps subnet "
+               "%(other_cidr)s of network %(other_net_id)s")
+
+
 class DhcpPortNotFoundOnNetwork(NotFound):
     message = ("DHCP_PORT could not be found on network %(net_id)s")
 
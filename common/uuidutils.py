@@ -15,3 +15,7 @@ def is_uuid_like(val):
     except (TypeError, ValueError, AttributeError):
         return False
 
+
+
+def generate_uuid():
+    return str(uuid.uuid4())
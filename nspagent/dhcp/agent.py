@@ -1,20 +1,33 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import collections
+import functools
 import os
+import time
 from gevent.pool import Pool
 import json
 from oslo_config import cfg
 from oslo_utils import importutils
+import six
 from linux import dhcp
 from linux import external_process
 from linux import utils as linux_utils
+import cachestore
+import leases
+import workqueue
+from common import addr_cache
 from common import exceptions
 from common import utils
 import traceback
 from webob import exc
 from logger import log as LOG
 
+# the driver action applying each kind of change
+_CHANGE_ACTIONS = {dhcp.CHANGE_OPTS: 'reload_allocations',
+                   dhcp.CHANGE_HOSTS: 'reload_allocations',
+                   dhcp.CHANGE_RESTART: 'restart'}
+
 
 class DhcpAgent(object):
     """DHCP agent service manager."""
@@ -25,26 +38,66 @@ class DhcpAgent(object):
         self.host = host
         self.conf = cfg.CONF
         self.pool = Pool(cfg.CONF.num_sync_threads)
+        self.queues = workqueue.NetworkWorkQueue(self.pool,
+                                                 cfg.CONF.job_history_size)
+        self.bulk_pool = Pool(cfg.CONF.bulk_network_concurrency)
+        self.reloader = None
+        if cfg.CONF.dhcp_reload_coalesce_window > 0:
+            self.reloader = workqueue.ReloadCoalescer(
+                self.queues, self._reload_network,
+                cfg.CONF.dhcp_reload_coalesce_window,
+                cfg.CONF.dhcp_reload_coalesce_max_delay)
         self.cache = NetworkCache()
+        # network id -> driver instance, from its first use until disable
+        self.drivers = {}
+        # how many updates were classified as each change
+        self.change_stats = collections.Counter(
+            dict.fromkeys(dhcp.CHANGES, 0))
         self.dhcp_driver_cls = importutils.import_class(self.conf.dhcp_driver)
+        listener = self.dhcp_driver_cls.get_cache_listener()
+        if listener is not None:
+            self.cache.add_listener(listener)
         self.plugin_rpc = None
        # create dhcp dir to store dhcp info
         dhcp_dir = os.path.dirname("/%s/dhcp/" % self.conf.state_path)
         linux_utils.ensure_dir(dhcp_dir)
         self.dhcp_version = self.dhcp_driver_cls.check_version()
+        self.leases = leases.LeaseIndex(functools.partial(
+            self.dhcp_driver_cls.get_lease_file_name, self.conf))
         self._populate_networks_cache()
         self._process_monitor = external_process.ProcessMonitor(
             config=self.conf,
             resource_type='dhcp')
 
     def _populate_networks_cache(self):
-        """Populate the networks cache when the DHCP-agent starts."""
+        """Populate the networks cache when the DHCP-agent starts.
+
+        With network_cache_persistence the full network state saved by the
+        previous run is restored first; networks the DHCP driver no longer
+        has configs for are dropped from it.
+        """
+        store = None
+        if self.conf.network_cache_persistence:
+            store = cachestore.CacheStore(
+                self.conf.network_cache_dir,
+                self.conf.use_namespaces,
+                sync_interval=self.conf.network_cache_sync_interval,
+                snapshot_interval=self.conf.network_cache_snapshot_interval,
+                max_records=self.conf.network_cache_journal_max_records)
+            store.load(self.cache)
         try:
             LOG.debug("conf:%s", self.conf)
             existing_networks = self.dhcp_driver_cls.existing_dhcp_networks(
                 self.conf
             )
+            for net_id in set(self.cache.get_network_ids()) - set(
+                    existing_networks):
+                LOG.debug("Dropping saved network %s, it has no DHCP "
+                          "configuration", net_id)
+                self.cache.remove(self.cache.get_network_by_id(net_id))
             for net_id in existing_networks:
+                if self.cache.get_network_by_id(net_id):
+                    continue
                 net = dhcp.NetModel(self.conf.use_namespaces,
                                     {"id": net_id,
                                      "subnets": [],
@@ -56,20 +109,30 @@ class DhcpAgent(object):
             LOG.debug("The '%s' DHCP-driver does not support retrieving of a "
                       "list of existing networks",
                       self.conf.dhcp_driver)
+        if store:
+            store.start(self.cache)
 
     def call_driver(self, action, network, **action_kwargs):
         """Invoke an action on a DHCP driver instance."""
         LOG.debug('Calling driver for network: %(net)s action: %(action)s',
                   {'net': network.id, 'action': action})
         try:
-            # the Driver expects something that is duck typed similar to
-            # the base models.
-            driver = self.dhcp_driver_cls(self.conf,
-                                          network,
-                                          self._process_monitor,
-                                          self.dhcp_version,
-                                          self.plugin_rpc)
-            getattr(driver, action)(**action_kwargs)
+            driver = self._get_driver(network)
+            previous = driver.network
+            driver.network = network
+            try:
+                getattr(driver, action)(**action_kwargs)
+            except Exception:
+                # the driver keeps serving what it served before
+                driver.network = previous
+                raise
+            if action == 'disable':
+                del self.drivers[network.id]
+            elif not any(s.enable_dhcp for s in network.subnets):
+                # reload_allocations stops dnsmasq once no subnet of the
+                # network has DHCP left, forget it as disable would
+                del self.drivers[network.id]
+                self.leases.forget(network.id)
             return True
         except exceptions.Conflict:
             # No need to resync here, the agent will receive the event related
@@ -94,6 +157,45 @@ class DhcpAgent(object):
                 LOG.error("enable dhcp err:%s", e)
                 LOG.error(traceback.format_exc())
 
+    def _get_driver(self, network):
+        """Return the driver of a network, creating it on first use.
+
+        A driver, its DeviceManager and interface driver live until DHCP
+        is disabled for the network, so state they compute survives from
+        one event to the next.  An existing driver keeps the network it
+        last served; call_driver hands it the newer one for the action
+        and only keeps it if the action succeeds.
+        """
+        driver = self.drivers.get(network.id)
+        if driver is None:
+            # the Driver expects something that is duck typed similar to
+            # the base models.
+            driver = self.dhcp_driver_cls(self.conf,
+                                          network,
+                                          self._process_monitor,
+                                          self.dhcp_version,
+                                          self.plugin_rpc)
+            self.drivers[network.id] = driver
+        return driver
+
+    def _request_reload(self, network, action):
+        """Reload or restart DHCP for a network, coalesced if configured.
+
+        With coalescing enabled an AsyncResult is returned which is ready
+        once the shared driver call has run.
+        """
+        if self.reloader:
+            return self.reloader.request(network.id, action)
+        self.call_driver(action, network)
+
+    def _reload_network(self, network_id, action):
+        """Run a coalesced driver action against the cached network."""
+        network = self.cache.get_network_by_id(network_id)
+        if network:
+            self.call_driver(action, network)
+        else:
+            LOG.debug("network_id: %s. network does not exist", network_id)
+
     def enable_dhcp_helper(self, network_id, network_rs=None):
         """Enable DHCP for a network that meets enabling criteria."""
         if network_rs:
@@ -127,12 +229,17 @@ class DhcpAgent(object):
         if network:
             if self.call_driver('disable', network):
                 self.cache.remove(network)
+                self.leases.forget(network_id)
 
-    def refresh_dhcp_helper(self, network_id, network=None):
+    def refresh_dhcp_helper(self, network_id, network=None, old_network=None):
         """Refresh or disable DHCP for a network depending on the current state
         of the network.
+
+        The change is classified against old_network, the cached network
+        by default.
         """
-        old_network = self.cache.get_network_by_id(network_id)
+        if old_network is None:
+            old_network = self.cache.get_network_by_id(network_id)
         if not old_network:
             # DHCP current not running for network.
             return self.enable_dhcp_helper(network_id, network)
@@ -140,77 +247,203 @@ class DhcpAgent(object):
         if not network:
             return
 
-        old_cidrs = set(s.cidr for s in old_network.subnets if s.enable_dhcp)
-        new_cidrs = set(s.cidr for s in network.subnets if s.enable_dhcp)
+        if not any(s.enable_dhcp for s in network.subnets):
+            self.disable_dhcp_helper(network.id)
+            return
 
-        if new_cidrs and old_cidrs == new_cidrs:
-            self.call_driver('reload_allocations', network)
-            self.cache.put(network)
-        elif new_cidrs:
+        change = self._classify_change(old_network, network)
+        if change == dhcp.CHANGE_RESTART:
             if self.call_driver('restart', network):
                 self.cache.put(network)
-        else:
-            self.disable_dhcp_helper(network.id)
+            return
+        if change != dhcp.CHANGE_NONE:
+            self.call_driver('reload_allocations', network)
+        self.cache.put(network)
+
+    def _classify_change(self, old_network, network):
+        """Return the cheapest change applying network over old_network."""
+        driver = self._get_driver(network)
+        previous = driver.network
+        # classify_change reads the new network from driver.network, which
+        # only keeps it once the action the change calls for has run
+        driver.network = network
+        try:
+            change = driver.classify_change(old_network)
+        except Exception as e:
+            LOG.warning("Unable to classify the update of network "
+                        "%(net)s, restarting DHCP: %(err)s",
+                        {'net': network.id, 'err': e})
+            change = dhcp.CHANGE_RESTART
+        finally:
+            driver.network = previous
+        self.change_stats[change] += 1
+        LOG.debug("Update of network %(net)s is a %(change)s change",
+                  {'net': network.id, 'change': change})
+        return change
+
+    def _async_requested(self, req):
+        """Whether the caller wants a job id instead of waiting."""
+        value = req.GET.get('async') if req is not None else None
+        if value is None:
+            return self.conf.async_api
+        return value.lower() in ('1', 'true', 'yes')
+
+    def _wait_or_accept(self, req, job, msg="SUCCESS"):
+        """Wait for job to finish, or hand back its id in async mode.
+
+        A job may return a message of its own, e.g. that what it was to
+        delete does not exist, which is answered instead of msg.
+        """
+        if self._async_requested(req):
+            return 202, {'job_id': job.id}
+        result = job.get()
+        if isinstance(result, six.string_types):
+            return 200, result
+        return 200, msg
+
+    @staticmethod
+    def _request_network_id(req):
+        """Return the network_id given in the query or body of req."""
+        if req is None:
+            return None
+        network_id = req.GET.get('network_id')
+        if network_id or not req.body:
+            return network_id
+        try:
+            payload = json.loads(req.body)
+        except ValueError:
+            return None
+        if isinstance(payload, dict):
+            return payload.get('network_id')
+        return None
+
+    def _find_network_id(self, lookup, kind, object_id):
+        """Return the id of the network a subnet or port is in.
+
+        The cache is asked with lookup(object_id) first, then the jobs
+        accepted but not finished yet, which may be about to add the
+        object.  None is returned when neither knows it.
+        """
+        network = lookup(object_id)
+        if network is not None:
+            return network.id
+        return self.queues.network_of((kind, object_id))
+
+    @staticmethod
+    def _network_keys(network):
+        """Return the keys a job announces for the body of a network."""
+        return ([('subnet', subnet['id'])
+                 for subnet in network.get('subnets') or []] +
+                [('port', port['id']) for port in network.get('ports') or []])
+
+    @staticmethod
+    def _port_keys(ports):
+        """Return the keys a job announces for PortModels."""
+        return [('port', port.id) for port in ports]
+
+    def _wait_or_accept_all(self, req, jobs):
+        """Like _wait_or_accept, for one job per network.
+
+        Waiting callers get the outcome of every network's job.
+        """
+        if self._async_requested(req):
+            return 202, {'jobs': dict((job.network_id, job.id)
+                                      for job in jobs)}
+        results = {}
+        for job in jobs:
+            try:
+                job.get()
+                results[job.network_id] = "SUCCESS"
+            except Exception as err:
+                results[job.network_id] = 'Error: %s' % err
+        return 200, results
+
+    def get_job(self, req=None, job_id=None, **kwargs):
+        job = self.queues.get_job(job_id)
+        if not job:
+            raise exc.HTTPNotFound()
+        return 200, job.to_dict()
 
     def network_create_end(self, req=None, **kwargs):
         try:
             payload = json.loads(req.body)
             network_id = payload['network']['id']
             network = payload['network']
-            #self.pool.spawn(self._network_create, network_id, network)
-            self._network_create(network_id, network)
-            LOG.debug("network_info:%s", self.cache.get_state())
-            return  200, "SUCCESS"
+            job = self.queues.submit(network_id, 'network_create',
+                                     self._network_create,
+                                     network_id, network)
+            self.queues.announce(job, self._network_keys(network))
+            return self._wait_or_accept(req, job)
         except Exception as err:
             LOG.error(err)
             raise Exception('Error: %s' % err)
 
-    @utils.synchronized('dhcp-agent')
     def _network_create(self, network_id, network):
         """Handle the network.create.end notification event."""
         try:
             self.enable_dhcp_helper(network_id, network)
+            LOG.debug("network_info:%s", self.cache.get_state())
         except Exception as err:
             LOG.error(err)
             LOG.error(traceback.format_exc())
             raise Exception('Error: %s' % err)
 
+    def network_bulk_create_end(self, req=None, **kwargs):
+        """Enable DHCP for many networks, setting them up concurrently.
+
+        The body looks like {"networks": [network, ...]}.  At most
+        bulk_network_concurrency networks are set up at the same time.
+        """
+        try:
+            payload = json.loads(req.body)
+            jobs = []
+            for network in payload['networks']:
+                job = workqueue.Job(network['id'], 'network_create',
+                                    self._network_create,
+                                    (network['id'], network), {})
+                jobs.append(self.queues.enqueue(job, pool=self.bulk_pool))
+                self.queues.announce(job, self._network_keys(network))
+            return self._wait_or_accept_all(req, jobs)
+        except Exception as err:
+            LOG.error(err)
+            raise Exception('Error: %s' % err)
+
     def network_updata_end(self, req=None, **kwargs):
         try:
             payload = json.loads(req.body)
             network_id = payload['network']['id']
             network = payload['network']
-            #self.pool.spawn(self._network_updata, network_id, network)
-            self._network_updata(network_id, network)
-            return 200, "SUCCESS"
+            job = self.queues.submit(network_id, 'network_update',
+                                     self._network_update,
+                                     network_id, network)
+            self.queues.announce(job, self._network_keys(network))
+            return self._wait_or_accept(req, job)
         except Exception as err:
             LOG.error(err)
             raise Exception('Error: %s' % err)
 
-    @utils.synchronized('dhcp-agent')
     def _network_update(self, network_id, network):
         """Handle the network.update.end notification event."""
         self.enable_dhcp_helper(network_id, network)
 
     def network_delete_end(self, req=None, network_id=None,**kwargs):
         try:
-            msg = "OK"
-            network = self.cache.get_network_by_id(network_id)
-            if network:
-                #self.pool.spawn(self._network_delete, network_id)
-                self._network_delete(network_id)
-            else:
-                msg = "network_id: %s. network does not exist" % network_id
-                LOG.debug(msg)
-            return 200, msg
+            # queued behind the create or update of the network, which
+            # may not have reached the cache yet
+            job = self.queues.submit(network_id, 'network_delete',
+                                     self._network_delete, network_id)
+            return self._wait_or_accept(req, job, "OK")
         except Exception  as err:
             LOG.error(err)
             raise Exception('Error: %s' % err)
 
-    @utils.synchronized('dhcp-agent')
     def _network_delete(self, network_id=None):
         """Handle the network.delete.end notification event."""
         try:
+            if not self.cache.get_network_by_id(network_id):
+                msg = "network_id: %s. network does not exist" % network_id
+                LOG.debug(msg)
+                return msg
             self.disable_dhcp_helper(network_id)
         except Exception  as err:
             LOG.error(err)
@@ -222,15 +455,16 @@ class DhcpAgent(object):
             payload = json.loads(req.body)
             network = payload['network']
             network_id = network['id']
-            #self.pool.spawn(self._subnet_update, network_id, network)
             LOG.debug("network_info:%s", self.cache.get_state())
-            ret = self._subnet_update(network_id, network)
-            return 200, msg
+            job = self.queues.submit(network_id, 'subnet_update',
+                                     self._subnet_update,
+                                     network_id, network)
+            self.queues.announce(job, self._network_keys(network))
+            return self._wait_or_accept(req, job, msg)
         except Exception as err:
             LOG.error(err)
             raise Exception('Err: %s ' % err)
 
-    @utils.synchronized('dhcp-agent')
     def _subnet_update(self, network_id, network):
         """Handle the subnet.update.end notification event."""
         self.refresh_dhcp_helper(network_id, network)
@@ -239,62 +473,98 @@ class DhcpAgent(object):
     subnet_create_end = subnet_update_end
 
     def subnet_delete_end(self, req=None, subnet_id=None, **kwargs):
+        """Remove a subnet, queued behind the other work of its network.
+
+        The network is the network_id given in the query or the body, or
+        else the one the cache, or a job accepted before, knows the
+        subnet in.
+        """
         try:
-            subnet = self.cache.get_subnet_by_id(subnet_id)
-            if subnet:
-                network = self.cache.get_network_by_subnet_id(subnet_id)
-                self.cache.remove_subnet(subnet)
-                #self.pool.spawn(self._subnet_delete, network.id, network)
-                self._subnet_delete(network.id, network)
-            else:
-                LOG.debug("subnet_id: %s. subnet does not exist", subnet_id)
+            network_id = (self._request_network_id(req) or
+                          self._find_network_id(
+                              self.cache.get_network_by_subnet_id,
+                              'subnet', subnet_id))
+            job = self.queues.submit(network_id, 'subnet_delete',
+                                     self._subnet_delete,
+                                     network_id, subnet_id)
+            return self._wait_or_accept(req, job, "SUCCESS")
         except Exception as err:
             LOG.error(err)
             raise Exception('Err: %s' % err)
 
-    @utils.synchronized('dhcp-agent')
-    def _subnet_delete(self, network_id, network):
+    def _subnet_delete(self, network_id, subnet_id):
         """Handle the subnet.delete.end notification event."""
-        self.refresh_dhcp_helper(network_id, network)
+        subnet = self.cache.get_subnet_by_id(subnet_id)
+        if not subnet:
+            msg = "subnet_id: %s. subnet does not exist" % subnet_id
+            LOG.debug(msg)
+            return msg
+        network = self.cache.get_network_by_subnet_id(subnet_id)
+        # remove_subnet edits the cached network and its ports in place,
+        # classify the change against a copy taken before
+        old_network = dhcp.NetModel(self.conf.use_namespaces,
+                                    network.to_dict())
+        self.cache.remove_subnet(subnet)
+        self.refresh_dhcp_helper(network.id, network, old_network)
 
     def port_update_end(self, req=None, **kwargs):
         try:
             payload = json.loads(req.body)
-            updated_port = dhcp.DictModel(payload)
-            LOG.debug("updated_port:%s", updated_port)
-            if updated_port:
-                #self.pool.spawn(self._port_update, updated_port)
-                self._port_update(updated_port)
-            else:
+            if not payload:
                 LOG.debug("updated_port is NULL")
                 return 200, "SUCCESS"
+            updated_port = self._port_model(payload)
+            LOG.debug("updated_port:%s", updated_port)
+            job = self.queues.submit(updated_port.network_id,
+                                     'port_update', self._port_update,
+                                     updated_port)
+            self.queues.announce(job, self._port_keys([updated_port]))
+            return self._wait_or_accept(req, job)
+        except exc.HTTPError:
+            raise
         except Exception as err:
             LOG.error(err)
             raise Exception('Err: %s' % err)
 
-    @utils.synchronized('dhcp-agent')
+    @staticmethod
+    def _port_model(port):
+        """Return the PortModel of a port body.
+
+        The body must give the port's id and network_id, which the work
+        queues and the cache are keyed by.
+        """
+        if not isinstance(port, dict):
+            raise exc.HTTPBadRequest('A port must be a JSON object')
+        missing = [key for key in ('id', 'network_id') if not port.get(key)]
+        if missing:
+            raise exc.HTTPBadRequest('Port body lacks %s' %
+                                     ', '.join(missing))
+        return dhcp.PortModel(port)
+
     def _port_update(self, updated_port):
         """Handle the port.update.end notification event."""
         network = self.cache.get_network_by_id(updated_port.network_id)
         LOG.debug("network:%s", network)
         if network:
-            driver_action = 'reload_allocations'
-            if self._is_port_on_this_agent(updated_port):
-                orig = self.cache.get_port_by_id(updated_port.id)
-                if orig:
-                    # assume IP change if not in cache
-                    old_ips = {i['ip_address'] for i in orig['fixed_ips'] or []}
-                else:
-                    old_ips = {}
-
-                new_ips = {i['ip_address'] for i in updated_port['fixed_ips']}
-                if old_ips != new_ips:
-                    driver_action = 'restart'
-            self.cache.put_port(updated_port)
-            self.call_driver(driver_action, network)
+            change = self._put_port(updated_port)
+            if change == dhcp.CHANGE_NONE:
+                LOG.debug("Port %s is unchanged for DHCP", updated_port.id)
+                return
+            return self._request_reload(network, _CHANGE_ACTIONS[change])
         else:
-            msg = "network_id: %s. network does not exist" % network_id
-            LOG.debug(msg)
+            LOG.debug("network_id: %s. network does not exist",
+                      updated_port.network_id)
+
+    def _put_port(self, updated_port):
+        """Store a port in the cache, return the change it makes."""
+        orig = self.cache.get_port_by_id(updated_port.id)
+        change = dhcp.classify_port_change(orig, updated_port)
+        if (change == dhcp.CHANGE_RESTART and
+                not self._is_port_on_this_agent(updated_port)):
+            change = dhcp.CHANGE_HOSTS
+        self.change_stats[change] += 1
+        self.cache.put_port(updated_port)
+        return change
 
     def _is_port_on_this_agent(self, port):
         thishost = utils.get_dhcp_agent_device_id(
@@ -306,37 +576,378 @@ class DhcpAgent(object):
     port_create_end = port_update_end
 
     def port_delete_end(self, req=None, port_id=None, **kwargs):
+        """Remove a port, queued behind the other work of its network.
+
+        The network is the network_id given in the query or the body, or
+        else the one the cache, or a job accepted before, knows the
+        port in.
+        """
         try:
-            msg = "SUCCESS"
-            port = self.cache.get_port_by_id(port_id)
-            if port:
-                #self.pool.spawn(self._port_delete, port_id)
-                self._port_delete(port_id)
-            else:
-                msg = "port_id: %s. PORT does not exist" % port_id
-                LOG.debug(msg)
-            return 200, msg
+            network_id = (self._request_network_id(req) or
+                          self._find_network_id(
+                              self.cache.get_network_by_port_id,
+                              'port', port_id))
+            job = self.queues.submit(network_id, 'port_delete',
+                                     self._port_delete, port_id)
+            return self._wait_or_accept(req, job, "SUCCESS")
         except Exception as err:
             LOG.error(err)
             raise Exception('Err: %s' %  err)
 
-    @utils.synchronized('dhcp-agent')
     def _port_delete(self, port_id):
         """Handle the port.delete.end notification event."""
         network = self.cache.get_network_by_port_id(port_id)
         port = self.cache.get_port_by_id(port_id)
+        if not port:
+            msg = "port_id: %s. PORT does not exist" % port_id
+            LOG.debug(msg)
+            return msg
         self.cache.remove_port(port)
-        self.call_driver('reload_allocations', network)
+        return self._request_reload(network, 'reload_allocations')
+
+    def port_bulk_end(self, req=None, **kwargs):
+        """Apply many port upserts and deletes with one reload per network.
+
+        The body looks like {"ports": [port, ...],
+                             "deleted_ports": [port_id, ...]}.
+        A deleted port may also be given as {"id": port_id,
+        "network_id": network_id}.  Deletes are applied after the upserts
+        of the same network, so a port both upserted and deleted is gone.
+        """
+        try:
+            payload = json.loads(req.body)
+            updated_ports = collections.defaultdict(list)
+            port_networks = {}
+            for port in payload.get('ports') or []:
+                port = self._port_model(port)
+                updated_ports[port.network_id].append(port)
+                port_networks[port.id] = port.network_id
+            deleted_port_ids = collections.defaultdict(list)
+            for deleted in payload.get('deleted_ports') or []:
+                if isinstance(deleted, dict):
+                    port_id = deleted['id']
+                    network_id = deleted.get('network_id')
+                else:
+                    port_id, network_id = deleted, None
+                network_id = (network_id or port_networks.get(port_id) or
+                              self._find_network_id(
+                                  self.cache.get_network_by_port_id,
+                                  'port', port_id))
+                if network_id is None:
+                    LOG.debug("port_id: %s. PORT does not exist", port_id)
+                else:
+                    deleted_port_ids[network_id].append(port_id)
+            jobs = []
+            for network_id in set(updated_ports) | set(deleted_port_ids):
+                ports = updated_ports.get(network_id, [])
+                job = self.queues.submit(
+                    network_id, 'port_bulk', self._port_bulk, network_id,
+                    ports, deleted_port_ids.get(network_id, []))
+                self.queues.announce(job, self._port_keys(ports))
+                jobs.append(job)
+            return self._wait_or_accept_all(req, jobs)
+        except exc.HTTPError:
+            raise
+        except Exception as err:
+            LOG.error(err)
+            raise Exception('Err: %s' % err)
+
+    def _port_bulk(self, network_id, updated_ports, deleted_port_ids):
+        """Apply a network's share of a bulk port request."""
+        network = self.cache.get_network_by_id(network_id)
+        if not network:
+            LOG.debug("network_id: %s. network does not exist", network_id)
+            return
+        changes = [self._put_port(port) for port in updated_ports]
+        for port_id in deleted_port_ids:
+            port = self.cache.get_port_by_id(port_id)
+            if port:
+                self.cache.remove_port(port)
+                changes.append(dhcp.CHANGE_HOSTS)
+            else:
+                LOG.debug("port_id: %s. PORT does not exist", port_id)
+        change = dhcp.strongest_change(changes)
+        LOG.debug("Bulk update of network %(net)s: %(updated)d ports "
+                  "updated, %(deleted)d deleted, %(change)s change",
+                  {'net': network_id, 'updated': len(updated_ports),
+                   'deleted': len(deleted_port_ids), 'change': change})
+        if change == dhcp.CHANGE_NONE:
+            return
+        return self._request_reload(network, _CHANGE_ACTIONS[change])
+
+    def sync_state(self, req=None, **kwargs):
+        """Converge on the complete set of networks this agent should serve.
+
+        The body looks like {"networks": [network, ...]}.  The desired
+        state is diffed against NetworkCache and only the networks that
+        differ get work queued: missing networks are created, extra ones
+        deleted, networks whose own attributes or subnets changed are
+        refreshed, and networks where only ports changed get one bulk port
+        update.
+        """
+        try:
+            payload = json.loads(req.body)
+            desired = dict((network['id'], network)
+                           for network in payload['networks'])
+            summary = {'created': 0, 'deleted': 0, 'refreshed': 0,
+                       'ports_updated': 0, 'unchanged': 0}
+            jobs = []
+            for network_id in self.cache.get_network_ids():
+                if network_id not in desired:
+                    summary['deleted'] += 1
+                    jobs.append(self.queues.submit(
+                        network_id, 'network_delete', self._network_delete,
+                        network_id))
+            for network_id, network in desired.items():
+                old_network = self.cache.get_network_by_id(network_id)
+                if not old_network:
+                    summary['created'] += 1
+                    jobs.append(self.queues.submit(
+                        network_id, 'network_create', self._network_create,
+                        network_id, network))
+                    self.queues.announce(jobs[-1],
+                                         self._network_keys(network))
+                    continue
+                new_network = dhcp.NetModel(self.conf.use_namespaces, network)
+                if self._network_needs_refresh(old_network, new_network):
+                    summary['refreshed'] += 1
+                    jobs.append(self.queues.submit(
+                        network_id, 'subnet_update', self._subnet_update,
+                        network_id, network))
+                    self.queues.announce(jobs[-1],
+                                         self._network_keys(network))
+                    continue
+                updated_ports, deleted_port_ids = self._diff_ports(
+                    old_network, new_network)
+                if updated_ports or deleted_port_ids:
+                    summary['ports_updated'] += 1
+                    jobs.append(self.queues.submit(
+                        network_id, 'port_bulk', self._port_bulk, network_id,
+                        updated_ports, deleted_port_ids))
+                    self.queues.announce(jobs[-1],
+                                         self._port_keys(updated_ports))
+                else:
+                    summary['unchanged'] += 1
+            LOG.debug("Full sync of %(count)d networks: %(summary)s",
+                      {'count': len(desired), 'summary': summary})
+            code, results = self._wait_or_accept_all(req, jobs)
+            return code, {'summary': summary, 'networks': results}
+        except Exception as err:
+            LOG.error(err)
+            raise Exception('Err: %s' % err)
+
+    @staticmethod
+    def _network_needs_refresh(old_network, new_network):
+        """Whether anything but the ports differs between two networks."""
+        for key in old_network._fields:
+            if key in ('ports', 'subnets'):
+                continue
+            if getattr(old_network, key) != getattr(new_network, key):
+                return True
+        old_subnets = dict((s.id, s) for s in old_network.subnets)
+        new_subnets = dict((s.id, s) for s in new_network.subnets)
+        return old_subnets != new_subnets
+
+    @staticmethod
+    def _diff_ports(old_network, new_network):
+        """Return the ports to upsert and the port ids to delete."""
+        old_ports = dict((p.id, p) for p in old_network.ports)
+        updated_ports = []
+        for port in new_network.ports:
+            if old_ports.pop(port.id, None) != port:
+                updated_ports.append(port)
+        return updated_ports, list(old_ports)
+
+    def get_ports_by_mac(self, req=None, mac_address=None, **kwargs):
+        network_id = req.GET.get('network_id') if req is not None else None
+        ports = self.cache.get_ports_by_mac(mac_address, network_id)
+        return 200, {'ports': [port.to_dict() for port in ports]}
+
+    def get_ports_by_ip(self, req=None, ip_address=None, **kwargs):
+        network_id = req.GET.get('network_id') if req is not None else None
+        ports = self.cache.get_ports_by_ip(ip_address, network_id)
+        return 200, {'ports': [port.to_dict() for port in ports]}
+
+    def get_state(self, req=None, **kwargs):
+        """Report cache statistics, cheap enough for monitoring scrapes.
+
+        ?network_id=<id> adds the counters of one network, ?detail=true
+        those of every network.  Reload, lease release and option sharing
+        counters are kept by the drivers, those of a network go away with
+        its driver.
+        """
+        state = self.cache.get_state()
+        state['pending_jobs'] = self.queues.pending()
+        state['changes'] = dict(self.change_stats)
+        state.update(self._get_driver_stats())
+        params = req.GET if req is not None else {}
+        network_id = params.get('network_id')
+        if network_id:
+            network_state = self.cache.get_network_state(network_id)
+            if network_state is None:
+                raise exc.HTTPNotFound()
+            driver = self.drivers.get(network_id)
+            if driver is not None:
+                network_state.update(driver.get_stats())
+            state['network'] = network_state
+        elif params.get('detail', '').lower() in ('1', 'true', 'yes'):
+            state['network_details'] = dict(
+                (net_id, self.cache.get_network_state(net_id))
+                for net_id in self.cache.get_network_ids())
+        return 200, state
+
+    def _get_driver_stats(self):
+        """Sum the reload, lease release and option sharing counters of
+        the drivers serving networks.
+
+        The last batch of lease releases is the one that ended last.
+        """
+        reloads = collections.Counter(performed=0, skipped=0)
+        releases = {'batches': 0, 'leases': 0, 'time': 0.0,
+                    'last_batch_leases': 0, 'last_batch_time': 0.0,
+                    'last_batch_at': None}
+        option_sets = collections.Counter(ports=0, sets=0, lines_saved=0,
+                                          bytes_saved=0)
+        for driver in self.drivers.values():
+            stats = driver.get_stats()
+            reloads.update(stats.get('reloads') or {})
+            option_sets.update(stats.get('option_sets') or {})
+            driver_releases = stats.get('lease_releases')
+            if not driver_releases:
+                continue
+            for key in ('batches', 'leases', 'time'):
+                releases[key] += driver_releases[key]
+            last_batch_at = driver_releases['last_batch_at']
+            if last_batch_at is not None and (
+                    releases['last_batch_at'] is None or
+                    last_batch_at > releases['last_batch_at']):
+                for key in ('last_batch_leases', 'last_batch_time',
+                            'last_batch_at'):
+                    releases[key] = driver_releases[key]
+        return {'reloads': dict(reloads), 'lease_releases': releases,
+                'option_sets': dict(option_sets)}
+
+    def get_lease_stats(self, req=None, **kwargs):
+        """Report active leases and utilization per network and subnet.
+
+        ?network_id=<id> limits the report to one network and lists its
+        active leases.  Lease files are only re-read when they changed.
+        """
+        network_id = req.GET.get('network_id') if req is not None else None
+        if network_id:
+            network = self.cache.get_network_by_id(network_id)
+            if not network:
+                raise exc.HTTPNotFound()
+            networks = [network]
+        else:
+            networks = [self.cache.get_network_by_id(net_id)
+                        for net_id in self.cache.get_network_ids()]
+
+        now = time.time()
+        result = {}
+        for network in networks:
+            self.leases.refresh(network.id)
+            active = self.leases.get_leases(network.id, now)
+            if self.dhcp_driver_cls.shares_lease_file:
+                subnets = [addr_cache.network(s.cidr)
+                           for s in network.subnets]
+                active = [lease for lease in active
+                          if any(subnet.contains(
+                              addr_cache.address(lease.ip_address))
+                              for subnet in subnets)]
+            result[network.id] = self._lease_stats(network, active)
+            if network_id:
+                result[network.id]['leases'] = [
+                    dict(lease._asdict()) for lease in active]
+        return 200, {'networks': result}
+
+    def _lease_stats(self, network, active):
+        subnet_leases = collections.Counter()
+        cidrs = None
+        for lease in active:
+            subnet_id = None
+            # the cache knows the subnet of every allocated address
+            for port in self.cache.get_ports_by_ip(lease.ip_address,
+                                                   network.id):
+                for fixed_ip in port.fixed_ips:
+                    if fixed_ip.ip_address == lease.ip_address:
+                        subnet_id = fixed_ip.subnet_id
+            if subnet_id is None:
+                if cidrs is None:
+                    cidrs = [(addr_cache.network(s.cidr), s.id)
+                             for s in network.subnets]
+                address = addr_cache.address(lease.ip_address)
+                for cidr, cidr_subnet_id in cidrs:
+                    if cidr.contains(address):
+                        subnet_id = cidr_subnet_id
+                        break
+            subnet_leases[subnet_id] += 1
+
+        subnets = {}
+        for subnet in network.subnets:
+            cidr = addr_cache.network(subnet.cidr)
+            size = cidr.size
+            if cidr.version == 4 and cidr.prefixlen < 31:
+                # network and broadcast addresses
+                size -= 2
+            count = subnet_leases.get(subnet.id, 0)
+            subnets[subnet.id] = {
+                'cidr': subnet.cidr,
+                'size': size,
+                'allocated_ips': self.cache.fixed_ip_counts.get(subnet.id, 0),
+                'active_leases': count,
+                'utilization': float(count) / size if size > 0 else 0.0}
+        return {'active_leases': len(active),
+                'subnets': subnets}
 
     def default(self, req=None, **kwargs):
         raise exc.HTTPNotFound()
 
 class NetworkCache(object):
-    """Agent cache of the current network state."""
+    """Agent cache of the current network state.
+
+    Besides the networks themselves the cache keeps dict indexes so that
+    every lookup and every port/subnet mutation is O(1) in the size of the
+    network: ports and subnets by id, the position of each port in its
+    network's port list, and ports by MAC address, by IP address and by
+    subnet.  Statistics are kept up to date the same way, so reading them
+    never walks the networks.
+    """
     def __init__(self):
         self.cache = {}
         self.subnet_lookup = {}
         self.port_lookup = {}
+        self.subnets = {}
+        self.ports = {}
+        # position of each port in its network's ports list
+        self.port_index = {}
+        self.mac_lookup = collections.defaultdict(set)
+        self.ip_lookup = collections.defaultdict(set)
+        self.subnet_ports = collections.defaultdict(set)
+        self.num_subnets = 0
+        self.num_ports = 0
+        # per network: number of ports by device_owner
+        self.owner_counts = collections.defaultdict(collections.Counter)
+        # per subnet: number of fixed IPs allocated from it
+        self.fixed_ip_counts = collections.Counter()
+        # a cachestore.CacheStore journaling every mutation, if persistent
+        self.store = None
+        # told about every network, subnet and port added or dropped
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Tell listener, e.g. the DHCP driver's CacheListener, about
+        every network, subnet and port the cache adds or drops.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+    def _record(self, op, **data):
+        if self.store:
+            self.store.record(op, **data)
 
     def get_network_ids(self):
         return self.cache.keys()
@@ -350,88 +961,207 @@ class NetworkCache(object):
     def get_network_by_port_id(self, port_id):
         return self.cache.get(self.port_lookup.get(port_id))
 
+    def _index_port(self, network_id, port):
+        self.ports[port.id] = port
+        self.port_lookup[port.id] = network_id
+        self.mac_lookup[port.mac_address.lower()].add(port.id)
+        for fixed_ip in port.fixed_ips:
+            self.ip_lookup[fixed_ip.ip_address].add(port.id)
+            self.subnet_ports[fixed_ip.subnet_id].add(port.id)
+            self.fixed_ip_counts[fixed_ip.subnet_id] += 1
+        self.num_ports += 1
+        self.owner_counts[network_id][port.device_owner] += 1
+        self._notify('port_added', network_id, port)
+
+    def _unindex_port(self, port):
+        network_id = self.port_lookup.pop(port.id)
+        del self.ports[port.id]
+        self._notify('port_removed', network_id, port)
+        self._discard(self.mac_lookup, port.mac_address.lower(), port.id)
+        for fixed_ip in port.fixed_ips:
+            self._discard(self.ip_lookup, fixed_ip.ip_address, port.id)
+            self._discard(self.subnet_ports, fixed_ip.subnet_id, port.id)
+            self._decrement(self.fixed_ip_counts, fixed_ip.subnet_id)
+        self.num_ports -= 1
+        owner_counts = self.owner_counts[network_id]
+        self._decrement(owner_counts, port.device_owner)
+        if not owner_counts:
+            del self.owner_counts[network_id]
+
+    @staticmethod
+    def _decrement(counter, key):
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    @staticmethod
+    def _discard(index, key, port_id):
+        port_ids = index.get(key)
+        if port_ids is not None:
+            port_ids.discard(port_id)
+            if not port_ids:
+                del index[key]
+
+    def _record_put(self, old_network, network):
+        """Journal a put, as what changed if the network was cached."""
+        if old_network is None:
+            self._record('put', network=network.to_dict())
+            return
+        attrs = dict((name, getattr(network, name))
+                     for name in network._fields
+                     if name not in ('subnets', 'ports'))
+        attrs['subnets'] = [subnet.to_dict() for subnet in network.subnets]
+        self._record('update_network', network=attrs)
+        old_ports = dict((port.id, port) for port in old_network.ports)
+        for port in network.ports:
+            old_port = old_ports.pop(port.id, None)
+            if old_port is None or (old_port is not port and
+                                    old_port != port):
+                port_dict = port.to_dict()
+                # replay finds the network of a port by its network_id
+                port_dict['network_id'] = network.id
+                self._record('put_port', port=port_dict)
+        for port_id in old_ports:
+            self._record('remove_port', port_id=port_id)
+
     def put(self, network):
-        if network.id in self.cache:
-            self.remove(self.cache[network.id])
+        old_network = self.cache.get(network.id)
+        if self.store:
+            self._record_put(old_network, network)
+
+        if old_network is not None:
+            self._remove(old_network)
+            # only the subnets the new network lacks are removed
+            subnet_ids = set(subnet.id for subnet in network.subnets)
+            for subnet in old_network.subnets:
+                if subnet.id not in subnet_ids:
+                    self._notify('subnet_removed', network.id, subnet.id)
 
         self.cache[network.id] = network
+        self._notify('network_added', network)
 
         for subnet in network.subnets:
             self.subnet_lookup[subnet.id] = network.id
+            self.subnets[subnet.id] = subnet
+        self.num_subnets += len(network.subnets)
 
-        for port in network.ports:
-            self.port_lookup[port.id] = network.id
+        for index, port in enumerate(network.ports):
+            self.port_index[port.id] = index
+            self._index_port(network.id, port)
 
     def remove(self, network):
+        self._record('remove', network_id=network.id)
+        self._remove(network)
+        for subnet in network.subnets:
+            self._notify('subnet_removed', network.id, subnet.id)
+
+    def _remove(self, network):
         del self.cache[network.id]
 
         for subnet in network.subnets:
             del self.subnet_lookup[subnet.id]
+            del self.subnets[subnet.id]
+            self.subnet_ports.pop(subnet.id, None)
+        self.num_subnets -= len(network.subnets)
 
         for port in network.ports:
-            del self.port_lookup[port.id]
+            del self.port_index[port.id]
+            self._unindex_port(port)
+        self._notify('network_removed', network.id)
 
     def put_port(self, port):
+        if self.store:
+            self._record('put_port', port=port.to_dict())
+        old_network_id = self.port_lookup.get(port.id)
+        if old_network_id is not None and old_network_id != port.network_id:
+            self._remove_port(self.ports[port.id])
         network = self.get_network_by_id(port.network_id)
-        for index in range(len(network.ports)):
-            if network.ports[index].id == port.id:
-                network.ports[index] = port
-                break
+        index = self.port_index.get(port.id)
+        if index is not None:
+            self._unindex_port(network.ports[index])
+            network.ports[index] = port
         else:
+            self.port_index[port.id] = len(network.ports)
             network.ports.append(port)
 
-        self.port_lookup[port.id] = network.id
+        self._index_port(network.id, port)
 
     def remove_port(self, port):
+        self._record('remove_port', port_id=port.id)
+        self._remove_port(port)
+
+    def _remove_port(self, port):
         network = self.get_network_by_port_id(port.id)
+        if not network:
+            return
 
-        for index in range(len(network.ports)):
-            if network.ports[index] == port:
-                del network.ports[index]
-                del self.port_lookup[port.id]
-                break
+        # fill the hole with the last port instead of shifting the list
+        index = self.port_index.pop(port.id)
+        last = network.ports.pop()
+        if last.id != port.id:
+            network.ports[index] = last
+            self.port_index[last.id] = index
+        self._unindex_port(port)
 
     def remove_subnet(self, subnet):
+        self._record('remove_subnet', subnet_id=subnet.id)
         network = self.get_network_by_subnet_id(subnet.id)
         LOG.debug("remove_subnet")
-        for index in range(len(network.subnets)):
-            if network.subnets[index] == subnet:
-                for port in network.ports:
-                    for fixed_ip in port.fixed_ips:
-                        if fixed_ip.subnet_id == subnet.id:
-                            port.fixed_ips.remove(fixed_ip)
-                        if len(port.fixed_ips) == 0:
-                            self.remove_port(port)
-                del network.subnets[index]
-                del self.subnet_lookup[subnet.id]
-                break
+        for port_id in list(self.subnet_ports.get(subnet.id, ())):
+            port = self.ports[port_id]
+            fixed_ips = [fixed_ip for fixed_ip in port.fixed_ips
+                         if fixed_ip.subnet_id != subnet.id]
+            if fixed_ips:
+                self._unindex_port(port)
+                port.fixed_ips = fixed_ips
+                self._index_port(network.id, port)
+            else:
+                self._remove_port(port)
+
+        network.subnets[:] = [s for s in network.subnets
+                              if s.id != subnet.id]
+        del self.subnet_lookup[subnet.id]
+        del self.subnets[subnet.id]
+        self.subnet_ports.pop(subnet.id, None)
+        self._notify('subnet_removed', network.id, subnet.id)
+        self.num_subnets -= 1
 
     def get_port_by_id(self, port_id):
-        network = self.get_network_by_port_id(port_id)
-        if network:
-            for port in network.ports:
-                if port.id == port_id:
-                    return port
+        return self.ports.get(port_id)
 
     def get_subnet_by_id(self, subnet_id):
-        network = self.get_network_by_subnet_id(subnet_id)
-        if network:
-            for subnet in network.subnets:
-                if subnet.id == subnet_id:
-                    return subnet
+        return self.subnets.get(subnet_id)
 
-    def get_state(self):
-        net_ids = self.get_network_ids()
-        num_nets = len(net_ids)
-        num_subnets = 0
-        num_ports = 0
-        for net_id in net_ids:
-            network = self.get_network_by_id(net_id)
-            num_subnets += len(network.subnets)
-            num_ports += len(network.ports)
-        return {'networks': num_nets,
-                'subnets': num_subnets,
-                'ports': num_ports}
+    def _get_ports(self, port_ids, network_id=None):
+        ports = [self.ports[port_id] for port_id in port_ids]
+        if network_id:
+            ports = [port for port in ports if port.network_id == network_id]
+        return ports
+
+    def get_ports_by_mac(self, mac_address, network_id=None):
+        return self._get_ports(self.mac_lookup.get(mac_address.lower(), ()),
+                               network_id)
 
+    def get_ports_by_ip(self, ip_address, network_id=None):
+        return self._get_ports(self.ip_lookup.get(ip_address, ()),
+                               network_id)
 
+    def get_ports_by_subnet_id(self, subnet_id):
+        return self._get_ports(self.subnet_ports.get(subnet_id, ()))
 
+    def get_state(self):
+        return {'networks': len(self.cache),
+                'subnets': self.num_subnets,
+                'ports': self.num_ports}
+
+    def get_network_state(self, network_id):
+        network = self.get_network_by_id(network_id)
+        if not network:
+            return None
+        return {'subnets': len(network.subnets),
+                'ports': len(network.ports),
+                'ports_by_device_owner': dict(
+                    self.owner_counts.get(network_id, {})),
+                'fixed_ips_by_subnet': dict(
+                    (subnet.id, self.fixed_ip_counts.get(subnet.id, 0))
+                    for subnet in network.subnets)}
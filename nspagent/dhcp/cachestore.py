@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import json
+import os
+import tempfile
+import time
+
+import gevent
+from linux import dhcp
+from linux import utils as linux_utils
+from logger import log as LOG
+
+
+class CacheStore(object):
+    """Persist NetworkCache as a snapshot plus a journal of mutations.
+
+    Every mutation applied to the cache is appended to the journal as one
+    JSON line.  Lines are buffered in memory and written out with a single
+    fsync every sync_interval seconds.  Every snapshot_interval seconds, or
+    once the journal holds max_records lines, the whole cache is written
+    to a new snapshot and the journal starts over.
+
+    On startup the snapshot is loaded and the journal replayed on top of
+    it.  A crash can leave a partially written last line in the journal;
+    lines that cannot be decoded are logged and skipped.
+
+    Writing the snapshot and the journal, fsync included, runs in the hub's
+    threadpool so other greenlets keep running meanwhile.
+    """
+
+    def __init__(self, path, use_namespaces, sync_interval=1.0,
+                 snapshot_interval=300, max_records=10000):
+        linux_utils.ensure_dir(path)
+        self.snapshot_file = os.path.join(path, 'snapshot')
+        self.journal_file = os.path.join(path, 'journal')
+        self.use_namespaces = use_namespaces
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_records = max_records
+        self._cache = None
+        self._journal = None
+        self._buffer = []
+        self._records = 0
+        self._last_snapshot = time.time()
+
+    def load(self, cache):
+        """Fill an empty cache from the snapshot and the journal."""
+        started = time.time()
+        networks = 0
+        try:
+            with open(self.snapshot_file) as f:
+                for network in json.load(f)['networks']:
+                    cache.put(dhcp.NetModel(self.use_namespaces, network))
+                    networks += 1
+        except IOError:
+            LOG.debug("No network cache snapshot at %s", self.snapshot_file)
+        except ValueError as e:
+            LOG.error("Ignoring corrupt network cache snapshot %(file)s: "
+                      "%(err)s", {'file': self.snapshot_file, 'err': e})
+
+        records = 0
+        try:
+            with open(self.journal_file) as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOG.warning("Skipping undecodable record at line "
+                                    "%(line)d of network cache journal "
+                                    "%(file)s", {'line': lineno,
+                                                 'file': self.journal_file})
+                        continue
+                    self._replay(cache, record)
+                    records += 1
+        except IOError:
+            LOG.debug("No network cache journal at %s", self.journal_file)
+
+        LOG.info("Loaded %(networks)d networks and replayed %(records)d "
+                 "journal records in %(time).3fs",
+                 {'networks': networks, 'records': records,
+                  'time': time.time() - started})
+
+    def _replay(self, cache, record):
+        op = record['op']
+        if op == 'put':
+            cache.put(dhcp.NetModel(self.use_namespaces, record['network']))
+        elif op == 'update_network':
+            # the ports follow as put_port and remove_port records
+            network = record['network']
+            old_network = cache.get_network_by_id(network['id'])
+            network['ports'] = old_network.ports if old_network else []
+            cache.put(dhcp.NetModel(self.use_namespaces, network))
+        elif op == 'remove':
+            network = cache.get_network_by_id(record['network_id'])
+            if network:
+                cache.remove(network)
+        elif op == 'put_port':
+            port = dhcp.PortModel(record['port'])
+            if cache.get_network_by_id(port.network_id):
+                cache.put_port(port)
+        elif op == 'remove_port':
+            port = cache.get_port_by_id(record['port_id'])
+            if port:
+                cache.remove_port(port)
+        elif op == 'remove_subnet':
+            subnet = cache.get_subnet_by_id(record['subnet_id'])
+            if subnet:
+                cache.remove_subnet(subnet)
+        else:
+            LOG.warning("Unknown network cache journal record: %s", op)
+
+    def start(self, cache):
+        """Compact what was loaded and start journaling cache mutations."""
+        self._cache = cache
+        self.snapshot()
+        cache.store = self
+        gevent.spawn(self._periodic_sync)
+
+    def record(self, op, **data):
+        data['op'] = op
+        self._buffer.append(json.dumps(data))
+
+    def flush(self):
+        """Write buffered journal records and fsync them."""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        gevent.get_hub().threadpool.apply(self._write_journal, (lines,))
+        self._records += len(lines)
+
+    def _write_journal(self, lines):
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a')
+        self._journal.write('\n'.join(lines) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def snapshot(self):
+        """Write the whole cache to a new snapshot and reset the journal."""
+        started = time.time()
+        # the cache is only read here, in the hub; the threadpool gets
+        # plain dicts the greenlets mutating the cache never touch
+        networks = []
+        for network_id in self._cache.get_network_ids():
+            network = self._cache.get_network_by_id(network_id)
+            networks.append(network.to_dict())
+        # everything buffered so far is part of the snapshot, records
+        # buffered while it is written go to the new journal
+        self._buffer = []
+        gevent.get_hub().threadpool.apply(self._write_snapshot, (networks,))
+        self._records = 0
+        self._last_snapshot = time.time()
+        LOG.debug("Wrote network cache snapshot of %(count)d networks in "
+                  "%(time).3fs", {'count': len(networks),
+                                   'time': self._last_snapshot - started})
+
+    def _write_snapshot(self, networks):
+        base_dir = os.path.dirname(self.snapshot_file)
+        with tempfile.NamedTemporaryFile('w', dir=base_dir,
+                                         delete=False) as f:
+            json.dump({'networks': networks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(f.name, self.snapshot_file)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_file, 'w')
+
+    def _periodic_sync(self):
+        while True:
+            gevent.sleep(self.sync_interval)
+            try:
+                dirty = self._records or self._buffer
+                if dirty and (self._records + len(self._buffer) >=
+                              self.max_records or
+                              time.time() - self._last_snapshot >=
+                              self.snapshot_interval):
+                    self.snapshot()
+                else:
+                    self.flush()
+            except Exception as e:
+                LOG.error("Failed to persist the network cache: %s", e)
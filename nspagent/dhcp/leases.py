@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import collections
+import os
+import time
+
+from logger import log as LOG
+
+
+class Lease(collections.namedtuple(
+        'Lease', 'ip_address mac_address expiry hostname client_id')):
+    """A lease from a dnsmasq lease database.
+
+    expiry is the epoch time the lease ends at, 0 for an infinite lease.
+    mac_address is None for DHCPv6 leases, which record an IAID instead.
+    """
+
+    __slots__ = ()
+
+    def active(self, now=None):
+        return self.expiry == 0 or self.expiry > (now or time.time())
+
+
+def _is_mac(value):
+    return len(value) == 17 and value.count(':') == 5
+
+
+class LeaseIndex(object):
+    """In-memory index of the leases dnsmasq recorded for each network.
+
+    dnsmasq rewrites its whole lease file in place whenever a lease
+    changes, so there is nothing to tail: a file is re-read only when its
+    inode, size or mtime changed since it was last read, everything else
+    is served from the index.  Leases are indexed by IP and MAC address;
+    expiry is checked when they are looked up.
+
+    lease_file_name(network_id) returns the lease file of a network.
+    Networks sharing a lease file share its index, which then holds the
+    leases of all of them.
+    """
+
+    def __init__(self, lease_file_name):
+        self._lease_file_name = lease_file_name
+        # lease file -> (inode, size, mtime) of the file last read
+        self._files = {}
+        # lease file -> {ip_address: Lease}
+        self._leases = {}
+        # lease file -> {mac_address: set of ip_address}
+        self._macs = {}
+
+    def refresh(self, network_id):
+        """Re-read the lease file of a network if it changed.
+
+        Returns True if the file was read.
+        """
+        filename = self._lease_file_name(network_id)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self.forget(network_id)
+            return False
+        signature = (st.st_ino, st.st_size, st.st_mtime)
+        if self._files.get(filename) == signature:
+            return False
+
+        leases = {}
+        macs = collections.defaultdict(set)
+        for lease in self._read(filename):
+            leases[lease.ip_address] = lease
+            if lease.mac_address:
+                macs[lease.mac_address].add(lease.ip_address)
+        self._files[filename] = signature
+        self._leases[filename] = leases
+        self._macs[filename] = macs
+        return True
+
+    def _read(self, filename):
+        try:
+            with open(filename) as f:
+                lines = f.readlines()
+        except IOError as e:
+            LOG.debug("Unable to read lease file %(file)s: %(err)s",
+                      {'file': filename, 'err': e})
+            return
+        for line in lines:
+            # IPv4: expiry mac ip hostname client-id
+            # IPv6: expiry iaid ip hostname client-id, after a duid line
+            fields = line.split()
+            if len(fields) < 3 or fields[0] == 'duid':
+                continue
+            try:
+                expiry = int(fields[0])
+            except ValueError:
+                continue
+            mac_address = fields[1].lower() if _is_mac(fields[1]) else None
+            hostname = fields[3] if len(fields) > 3 else '*'
+            client_id = fields[4] if len(fields) > 4 else '*'
+            yield Lease(fields[2].strip('[]'), mac_address, expiry,
+                        hostname, client_id)
+
+    def forget(self, network_id):
+        filename = self._lease_file_name(network_id)
+        self._files.pop(filename, None)
+        self._leases.pop(filename, None)
+        self._macs.pop(filename, None)
+
+    def get_leases(self, network_id, now=None):
+        """Return the active leases in the lease file of a network."""
+        now = now or time.time()
+        leases = self._leases.get(self._lease_file_name(network_id), {})
+        return [lease for lease in leases.values() if lease.active(now)]
+
+    def get_lease_by_ip(self, network_id, ip_address, now=None):
+        filename = self._lease_file_name(network_id)
+        lease = self._leases.get(filename, {}).get(ip_address)
+        if lease and lease.active(now):
+            return lease
+        return None
+
+    def get_leases_by_mac(self, network_id, mac_address, now=None):
+        filename = self._lease_file_name(network_id)
+        leases = self._leases.get(filename, {})
+        found = [leases[ip] for ip in
+                 self._macs.get(filename, {}).get(mac_address.lower(), ())]
+        return [lease for lease in found if lease.active(now)]
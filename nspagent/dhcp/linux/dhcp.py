@@ -2,6 +2,8 @@
 # encoding: utf-8
 import abc
 import collections
+import hashlib
+import heapq
 import os
 import re
 import shutil
@@ -11,12 +13,14 @@ import netaddr
 from oslo_config import cfg
 
 from oslo_utils import importutils
+from oslo_utils import lockutils
 import six
 #from common import ovs_lib
 import external_process
 import ip_lib
 import iptables_manager
 import utils
+from common import addr_cache
 from common import constants
 from common import exceptions
 from common import ipv6_utils
@@ -37,6 +41,8 @@ METADATA_DEFAULT_CIDR = '%s/%d' % (METADATA_DEFAULT_IP,
 METADATA_PORT = 80
 WIN2k3_STATIC_DNS = 249
 NS_PREFIX = 'qdhcp-'
+# exit code of dhcp_release_batch when only some leases were released
+RELEASE_BATCH_PARTIAL_FAILURE = 3
 DNSMASQ_SERVICE_NAME = 'dnsmasq'
 
 
@@ -82,7 +88,121 @@ class DictModel(dict):
         del self[name]
 
 
-class NetModel(DictModel):
+def _intern(value):
+    """Intern ids and MACs, which repeat across networks, ports and files."""
+    if value is None:
+        return None
+    try:
+        return intern(str(value))
+    except UnicodeError:
+        return value
+
+
+class _Model(object):
+    """Compact, slotted replacement for DictModel.
+
+    Only the fields listed in _fields are kept from the controller payload,
+    missing ones default to None.  Fields in _nested hold lists of nested
+    models, fields in _lists plain lists, and values of fields in _interned
+    are interned.  Item access and get() are supported so code written
+    against DictModel keeps working.
+    """
+    __slots__ = ()
+    _fields = ()
+    _nested = {}
+    _lists = ()
+    _interned = ()
+
+    def __init__(self, d=None):
+        if isinstance(d, _Model):
+            d = dict((name, getattr(d, name)) for name in d._fields)
+        elif d is None:
+            d = {}
+        for name in self._fields:
+            value = d.get(name)
+            if name in self._nested:
+                cls = self._nested[name]
+                value = [item if isinstance(item, cls) else cls(item)
+                         for item in value or ()]
+            elif name in self._lists:
+                value = list(value or ())
+            elif name in self._interned:
+                value = _intern(value)
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def to_dict(self):
+        d = {}
+        for name in self._fields:
+            value = getattr(self, name)
+            if name in self._nested:
+                value = [item.to_dict() for item in value]
+            elif name in self._lists:
+                value = list(value)
+            d[name] = value
+        return d
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self._fields)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+
+class FixedIP(_Model):
+    __slots__ = _fields = ('subnet_id', 'ip_address')
+    _interned = ('subnet_id',)
+
+
+class DhcpOpt(_Model):
+    __slots__ = _fields = ('opt_name', 'opt_value', 'ip_version')
+
+
+class HostRoute(_Model):
+    __slots__ = _fields = ('destination', 'nexthop')
+
+
+class SubnetModel(_Model):
+    __slots__ = _fields = ('id', 'network_id', 'cidr', 'ip_version',
+                           'enable_dhcp', 'gateway_ip', 'dns_nameservers',
+                           'host_routes', 'ipv6_address_mode',
+                           'ipv6_ra_mode')
+    _nested = {'host_routes': HostRoute}
+    _lists = ('dns_nameservers',)
+    _interned = ('id', 'network_id')
+
+
+class PortModel(_Model):
+    __slots__ = _fields = ('id', 'network_id', 'mac_address', 'device_owner',
+                           'device_id', 'admin_state_up', 'fixed_ips',
+                           'extra_dhcp_opts')
+    _nested = {'fixed_ips': FixedIP, 'extra_dhcp_opts': DhcpOpt}
+    _interned = ('id', 'network_id', 'mac_address', 'device_owner')
+
+
+class NetModel(_Model):
+    _fields = ('id', 'admin_state_up', 'interfacename', 'mtu', 'subnets',
+               'ports')
+    __slots__ = _fields + ('_ns_name',)
+    _nested = {'subnets': SubnetModel, 'ports': PortModel}
+    _interned = ('id',)
 
     def __init__(self, use_namespaces, d):
         super(NetModel, self).__init__(d)
@@ -95,6 +215,403 @@ class NetModel(DictModel):
         return self._ns_name
 
 
+# the lines a port contributes to each dnsmasq file; lease lines lack
+# the leading timestamp, which changes on every render.  opts_tag is the
+# shared tag of the port's options when they are written once for all
+# the ports with the same options, None when options are per port
+_PortFragments = collections.namedtuple(
+    '_PortFragments', 'hosts addn_hosts leases options allocations opts_tag')
+
+# the network wide settings a port's fragments depend on
+_RenderContext = collections.namedtuple(
+    '_RenderContext', 'dhcp_domain dhcp_enabled_subnet_ids v6_modes')
+
+
+class PortFragmentCache(object):
+    """LRU cache of the dnsmasq file lines rendered for each port.
+
+    An entry is only used for the very PortModel instance it was rendered
+    from and only when the network wide render context is unchanged.
+    NetworkCache replaces the PortModel on every update of a port, and
+    the DnsmasqCacheListener invalidates the entry whenever the cache
+    updates or removes a port, so an entry can never outlive the port
+    content it was rendered from.
+
+    Recency is tracked with a counter rather than by reordering on every
+    hit; once the cache grows past max_size the least recently used tenth
+    is evicted in one go.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = {}
+        self._tick = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return cfg.CONF.dnsmasq_port_fragment_cache_size
+        return self._max_size
+
+    def get(self, port, context):
+        entry = self._entries.get(port.id)
+        if entry is None or entry[0] is not port or entry[1] != context:
+            return None
+        self._tick += 1
+        entry[3] = self._tick
+        return entry[2]
+
+    def put(self, port, context, fragments):
+        max_size = self.max_size
+        if max_size <= 0:
+            return
+        self._tick += 1
+        self._entries[port.id] = [port, context, fragments, self._tick]
+        if len(self._entries) > max_size:
+            self._evict(len(self._entries) - max_size + max_size // 10)
+
+    def invalidate(self, port_id):
+        self._entries.pop(port_id, None)
+
+    def _evict(self, count):
+        for port_id, entry in heapq.nsmallest(
+                count, six.iteritems(self._entries),
+                key=lambda item: item[1][3]):
+            del self._entries[port_id]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+port_fragments = PortFragmentCache()
+
+
+class SubnetOptionCache(object):
+    """The dnsmasq options rendered for each subnet.
+
+    An entry is used while the subnet equals the one it was rendered from
+    and the render context, which holds the tag of the subnet, the IPv4
+    CIDRs of its network and its metadata route, is unchanged.
+    The DnsmasqCacheListener drops the entries of subnets removed from
+    the agent's NetworkCache.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, subnet, context):
+        entry = self._entries.get(subnet.id)
+        if (entry is None or entry[1] != context or
+                entry[0] is not subnet and entry[0] != subnet):
+            return None
+        return entry[2]
+
+    def put(self, subnet, context, options):
+        self._entries[subnet.id] = (subnet, context, options)
+
+    def invalidate(self, subnet_id):
+        self._entries.pop(subnet_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+subnet_options = SubnetOptionCache()
+
+
+class IsolationMap(object):
+    """The subnets of each network routed by a router port.
+
+    A subnet is routed when a router interface port holds its gateway
+    address.  The DnsmasqCacheListener keeps the map up to date as the
+    agent's NetworkCache indexes and unindexes ports, so the isolated
+    subnets of a cached network are known without scanning its ports.
+    The map only answers for the very NetModel instance last put for a
+    network.
+    """
+
+    def __init__(self):
+        # network id -> NetModel
+        self._networks = {}
+        # network id -> {subnet id: gateway ip}
+        self._gateways = {}
+        # network id -> number of router ports by routed subnet id
+        self._routed = {}
+
+    def put_network(self, network):
+        """Start tracking network, before any of its ports is added."""
+        self._networks[network.id] = network
+        self._gateways[network.id] = dict(
+            (subnet.id, subnet.gateway_ip) for subnet in network.subnets)
+        self._routed[network.id] = collections.Counter()
+
+    def remove_network(self, network_id):
+        self._networks.pop(network_id, None)
+        self._gateways.pop(network_id, None)
+        self._routed.pop(network_id, None)
+
+    def remove_subnet(self, network_id, subnet_id):
+        if network_id in self._networks:
+            self._gateways[network_id].pop(subnet_id, None)
+            self._routed[network_id].pop(subnet_id, None)
+
+    def _routed_subnets(self, network_id, port):
+        if port.device_owner not in constants.ROUTER_INTERFACE_OWNERS:
+            return ()
+        gateways = self._gateways.get(network_id)
+        if gateways is None:
+            return ()
+        return [alloc.subnet_id for alloc in port.fixed_ips
+                if gateways.get(alloc.subnet_id) == alloc.ip_address]
+
+    def add_port(self, network_id, port):
+        for subnet_id in self._routed_subnets(network_id, port):
+            self._routed[network_id][subnet_id] += 1
+
+    def remove_port(self, network_id, port):
+        for subnet_id in self._routed_subnets(network_id, port):
+            routed = self._routed[network_id]
+            routed[subnet_id] -= 1
+            if routed[subnet_id] <= 0:
+                del routed[subnet_id]
+
+    def get_isolated_subnets(self, network):
+        """Return the isolated subnets of network, None if not tracked."""
+        if self._networks.get(network.id) is not network:
+            return None
+        routed = self._routed[network.id]
+        isolated_subnets = collections.defaultdict(lambda: True)
+        for subnet in network.subnets:
+            isolated_subnets[subnet.id] = subnet.id not in routed
+        return isolated_subnets
+
+
+isolation_map = IsolationMap()
+
+
+class CacheListener(object):
+    """Told what the agent's NetworkCache adds and drops.
+
+    A driver whose get_cache_listener() returns one keeps what it derives
+    from the cached networks in step with them.  network_added() is
+    called before the ports of the network are added.
+    """
+
+    def network_added(self, network):
+        pass
+
+    def network_removed(self, network_id):
+        pass
+
+    def subnet_removed(self, network_id, subnet_id):
+        pass
+
+    def port_added(self, network_id, port):
+        pass
+
+    def port_removed(self, network_id, port):
+        pass
+
+
+class DnsmasqCacheListener(CacheListener):
+    """Keeps port_fragments, subnet_options and isolation_map in step."""
+
+    def network_added(self, network):
+        isolation_map.put_network(network)
+
+    def network_removed(self, network_id):
+        isolation_map.remove_network(network_id)
+
+    def subnet_removed(self, network_id, subnet_id):
+        isolation_map.remove_subnet(network_id, subnet_id)
+        subnet_options.invalidate(subnet_id)
+
+    def port_added(self, network_id, port):
+        isolation_map.add_port(network_id, port)
+
+    def port_removed(self, network_id, port):
+        port_fragments.invalidate(port.id)
+        isolation_map.remove_port(network_id, port)
+
+
+cache_listener = DnsmasqCacheListener()
+
+
+class OptionFormatter(object):
+    """Format dnsmasq --dhcp-option lines.
+
+    An option name may carry leading 'tag:<name>,' tags to match on, and
+    is prefixed with 'option:' or 'option6:' unless it is a numeric code.
+    The parsed form of each (ip_version, option) is memoized, only the tag
+    of the subnet or port is joined per line: port tags are unique per
+    port and would make the memo grow with the ports.  The memo is
+    dropped as a whole once it holds max_size options.
+    """
+
+    _OPTION_RE = re.compile(r'(tag:(.*),)?(.*)$')
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._options = {}
+
+    def _parse(self, ip_version, option):
+        matches = self._OPTION_RE.match(str(option))
+        extra_tag, option = matches.group(1), matches.group(3)
+        if not option.isdigit():
+            if ip_version == 4:
+                option = 'option:%s' % option
+            else:
+                option = 'option6:%s' % option
+        if extra_tag:
+            return ',%s%s' % (extra_tag, option)
+        return ',' + option
+
+    def _option(self, ip_version, option):
+        """Return ',[<extra tags>,]option:<name>' for option."""
+        key = (ip_version, option)
+        parsed = self._options.get(key)
+        if parsed is None:
+            if len(self._options) >= self.max_size:
+                self._options.clear()
+            parsed = self._options[key] = self._parse(ip_version, option)
+        return parsed
+
+    def format(self, ip_version, tag, option, *args):
+        line = 'tag:' + tag + self._option(ip_version, option)
+        if args:
+            return ','.join((line,) + args)
+        return line
+
+    def format_opts(self, tag, opts, ip_versions):
+        """Format the DhcpOpts whose IP version is in ip_versions.
+
+        Returns the option lines and the DhcpOpts skipped.
+        """
+        prefix = 'tag:' + tag
+        options = []
+        skipped = []
+        for opt in opts:
+            if opt.ip_version in ip_versions:
+                options.append('%s%s,%s' % (
+                    prefix, self._option(opt.ip_version, opt.opt_name),
+                    opt.opt_value))
+            else:
+                skipped.append(opt)
+        return options, skipped
+
+    def __len__(self):
+        return len(self._options)
+
+
+option_formatter = OptionFormatter()
+
+# digests of the config files last written for each network, by kind
+config_digests = {}
+
+# in hostsdir mode, the fragments last written to each port's files, by
+# network and port id
+port_file_state = {}
+
+# the groups of networks served by one dnsmasq, by name
+shared_groups = {}
+
+
+# the changes an update can make to the dnsmasq of a network, cheapest
+# first: none, options only, hosts (and options), or its command line
+CHANGE_NONE = 'none'
+CHANGE_OPTS = 'opts'
+CHANGE_HOSTS = 'hosts'
+CHANGE_RESTART = 'restart'
+CHANGES = (CHANGE_NONE, CHANGE_OPTS, CHANGE_HOSTS, CHANGE_RESTART)
+
+# subnet fields which are only rendered into the opts file
+_SUBNET_OPTION_FIELDS = ('dns_nameservers', 'gateway_ip', 'host_routes')
+
+
+def strongest_change(changes):
+    """Return the most expensive of changes, CHANGE_NONE if empty."""
+    return max(changes or [CHANGE_NONE], key=CHANGES.index)
+
+
+def classify_port_change(old_port, new_port):
+    """Return the change replacing old_port with new_port makes.
+
+    old_port is None for a new port and new_port None for a deleted one.
+    A new DHCP port, or new addresses on it, need a restart: the device
+    gets its addresses when DHCP is enabled and dnsmasq binds to them.
+    The DHCP port itself is not in the hosts files.
+    """
+    if old_port == new_port:
+        return CHANGE_NONE
+    if new_port is not None and (
+            new_port.device_owner == constants.DEVICE_OWNER_DHCP):
+        if old_port is None or old_port.fixed_ips != new_port.fixed_ips:
+            return CHANGE_RESTART
+        if old_port.device_owner == constants.DEVICE_OWNER_DHCP:
+            if old_port.extra_dhcp_opts != new_port.extra_dhcp_opts:
+                return CHANGE_OPTS
+            return CHANGE_NONE
+    if (old_port is None or new_port is None or
+            old_port.mac_address != new_port.mac_address or
+            old_port.device_owner != new_port.device_owner or
+            old_port.fixed_ips != new_port.fixed_ips or
+            # ports with options get a tag in the hosts files
+            bool(old_port.extra_dhcp_opts) !=
+            bool(new_port.extra_dhcp_opts)):
+        return CHANGE_HOSTS
+    if old_port.extra_dhcp_opts != new_port.extra_dhcp_opts:
+        if cfg.CONF.dnsmasq_share_option_tags:
+            # the tag of shared options is derived from the options
+            return CHANGE_HOSTS
+        return CHANGE_OPTS
+    return CHANGE_NONE
+
+
+def classify_network_change(old_network, new_network):
+    """Return the change replacing old_network with new_network makes.
+
+    Only the models are compared.  A change of the dnsmasq command line,
+    e.g. of a DHCP range or the MTU, is found by comparing it with the one
+    dnsmasq runs with, see Dnsmasq.classify_change.  The DHCP device gets
+    the prefix of every subnet when DHCP is enabled, so a changed CIDR
+    needs a restart as well.
+    """
+    if old_network.interfacename != new_network.interfacename:
+        return CHANGE_RESTART
+    changes = set()
+    if old_network.subnets != new_network.subnets:
+        if ([s.id for s in old_network.subnets] !=
+                [s.id for s in new_network.subnets]):
+            # subnet tags follow the order of the subnets
+            changes.add(CHANGE_HOSTS)
+        else:
+            for old, new in zip(old_network.subnets, new_network.subnets):
+                if old == new:
+                    continue
+                if old.cidr != new.cidr:
+                    return CHANGE_RESTART
+                if all(getattr(old, name) == getattr(new, name)
+                       for name in SubnetModel._fields
+                       if name not in _SUBNET_OPTION_FIELDS):
+                    changes.add(CHANGE_OPTS)
+                else:
+                    changes.add(CHANGE_HOSTS)
+    old_ports = dict((port.id, port) for port in old_network.ports)
+    for port in new_network.ports:
+        changes.add(classify_port_change(old_ports.pop(port.id, None), port))
+        if CHANGE_RESTART in changes:
+            return CHANGE_RESTART
+    for port in old_ports.values():
+        changes.add(classify_port_change(port, None))
+    return strongest_change(changes)
+
+
+def _digest(contents):
+    if isinstance(contents, six.text_type):
+        contents = contents.encode('utf-8')
+    return hashlib.sha1(contents).hexdigest()
+
+
 @six.add_metaclass(abc.ABCMeta)
 class DhcpBase(object):
 
@@ -104,9 +621,18 @@ class DhcpBase(object):
         self.conf = conf
         self.network = network
         self.process_monitor = process_monitor
-        self.device_manager = DeviceManager(self.conf, plugin)
+        self.device_manager = self._get_device_manager(plugin)
         self.version = version
         LOG.debug("__init__ DhcpBase  ok")
+
+    def _get_device_manager(self, plugin):
+        return DeviceManager(self.conf, plugin)
+
+    @property
+    def namespace(self):
+        """The namespace the DHCP server of the network runs in."""
+        return self.device_manager.get_namespace(self.network)
+
     @abc.abstractmethod
     def enable(self):
         """Enables DHCP for this network."""
@@ -129,6 +655,24 @@ class DhcpBase(object):
     def reload_allocations(self):
         """Force the DHCP server to reload the assignment database."""
 
+    def classify_change(self, old_network):
+        """Return the change applying self.network over old_network makes.
+
+        One of CHANGE_NONE, CHANGE_OPTS, CHANGE_HOSTS and CHANGE_RESTART;
+        only a CHANGE_RESTART needs restart(), the others are applied by
+        reload_allocations().
+        """
+        return CHANGE_RESTART
+
+    @classmethod
+    def get_cache_listener(cls):
+        """Return the CacheListener of the driver, or None."""
+        return None
+
+    def get_stats(self):
+        """Return the counters the driver keeps for its network, by name."""
+        return {}
+
     @classmethod
     def existing_dhcp_networks(cls, conf):
         """Return a list of existing networks ids that we have configs for."""
@@ -162,16 +706,28 @@ class DhcpLocalProcess(DhcpBase):
         self.confs_dir = self.get_confs_dir(conf)
         self.network_conf_dir = os.path.join(self.confs_dir, network.id)
         utils.ensure_dir(self.network_conf_dir)
+        # the process manager keeps the pid and liveness of dnsmasq
+        self._process_manager = None
+        # None until read from, or written to, the interface file
+        self._interface_name = None
         LOG.debug("__init__ DhcpLocalProcess ok")
     @staticmethod
     def get_confs_dir(conf):
         return os.path.abspath(os.path.normpath(conf.dhcp_confs))
 
+    @classmethod
+    def get_lease_file_name(cls, conf, network_id):
+        """Returns the lease file dnsmasq keeps for a network."""
+        return os.path.join(cls.get_confs_dir(conf), network_id, 'leases')
+
     def get_conf_file_name(self, kind):
         """Returns the file name for a given kind of config file."""
         return os.path.join(self.network_conf_dir, kind)
 
     def _remove_config_files(self):
+        self._interface_name = None
+        config_digests.pop(self.network.id, None)
+        port_file_state.pop(self.network.id, None)
         shutil.rmtree(self.network_conf_dir, ignore_errors=True)
 
     def _enable_dhcp(self):
@@ -193,13 +749,18 @@ class DhcpLocalProcess(DhcpBase):
             self.spawn_process()
 
     def _get_process_manager(self, cmd_callback=None):
-        return external_process.ProcessManager(
-            conf=self.conf,
-            uuid=self.network.id,
-            namespace=self.network.namespace,
-            default_cmd_callback=cmd_callback,
-            pid_file=self.get_conf_file_name('pid'),
-            run_as_root=True)
+        pm = self._process_manager
+        if pm is None:
+            pm = self._process_manager = external_process.ProcessManager(
+                conf=self.conf,
+                uuid=self.network.id,
+                namespace=self.namespace,
+                default_cmd_callback=cmd_callback,
+                pid_file=self.get_conf_file_name('pid'),
+                run_as_root=True)
+        elif cmd_callback:
+            pm.default_cmd_callback = cmd_callback
+        return pm
 
     def disable(self, retain_port=False):
         """Disable DHCP for this network by killing the local process."""
@@ -216,13 +777,13 @@ class DhcpLocalProcess(DhcpBase):
             LOG.warning(('Failed trying to delete interface: %s'),
                         self.interface_name)
 
-        if self.conf.dhcp_delete_namespaces and self.network.namespace:
-            ns_ip = ip_lib.IPWrapper(namespace=self.network.namespace)
+        if self.conf.dhcp_delete_namespaces and self.namespace:
+            ns_ip = ip_lib.IPWrapper(namespace=self.namespace)
             try:
-                ns_ip.netns.delete(self.network.namespace)
+                ns_ip.netns.delete(self.namespace)
             except RuntimeError:
                 LOG.warning(('Failed trying to delete namespace: %s'),
-                            self.network.namespace)
+                            self.namespace)
 
     def _get_value_from_conf_file(self, kind, converter=None):
         """A helper function to read a value from one of the state files."""
@@ -243,12 +804,16 @@ class DhcpLocalProcess(DhcpBase):
 
     @property
     def interface_name(self):
-        return self._get_value_from_conf_file('interface')
+        if self._interface_name is None:
+            self._interface_name = self._get_value_from_conf_file(
+                'interface')
+        return self._interface_name
 
     @interface_name.setter
     def interface_name(self, value):
         interface_file_path = self.get_conf_file_name('interface')
         utils.replace_file(interface_file_path, value)
+        self._interface_name = value
 
     @property
     def active(self):
@@ -270,9 +835,71 @@ class Dnsmasq(DhcpLocalProcess):
 
     _TAG_PREFIX = 'tag%d'
 
+    # whether the lease file of a network also holds other networks' leases
+    shares_lease_file = False
+
+    # first version with --dhcp-hostsdir, --hostsdir and --dhcp-optsdir
+    MINIMUM_HOSTSDIR_VERSION = (2, 73)
+
+    # per-port file directories, by the kind of file they replace
+    PORT_DIRS = (('host', 'hostsdir'),
+                 ('addn_hosts', 'addn_hostsdir'),
+                 ('opts', 'optsdir'))
+
+    def __init__(self, conf, network, process_monitor, version=None,
+                 plugin=None):
+        super(Dnsmasq, self).__init__(conf, network, process_monitor,
+                                      version, plugin)
+        # how many reloads signalled dnsmasq and how many were skipped
+        # because none of its files changed
+        self.reload_stats = collections.Counter(performed=0, skipped=0)
+        # stale lease releases: batches run, leases released, seconds
+        # spent, and the size, duration and end of the last batch
+        self.release_stats = {'batches': 0, 'leases': 0, 'time': 0.0,
+                              'last_batch_leases': 0,
+                              'last_batch_time': 0.0,
+                              'last_batch_at': None}
+        # how many ports share how many option sets and the lines and
+        # bytes of the opts file saved, None when no set is shared
+        self.option_set_stats = None
+
+    def get_stats(self):
+        return {'reloads': dict(self.reload_stats),
+                'lease_releases': dict(self.release_stats),
+                'option_sets': self.option_set_stats}
+
+    @classmethod
+    def get_cache_listener(cls):
+        return cache_listener
+
     @classmethod
     def check_version(cls):
-        pass
+        """Probe the installed dnsmasq, return its version as a tuple.
+
+        None is returned when the version cannot be determined, which
+        limits the driver to the features every dnsmasq supports.
+        """
+        try:
+            out = utils.execute(['dnsmasq', '--version'])
+        except (OSError, RuntimeError) as e:
+            LOG.warning("Unable to determine the dnsmasq version: %s", e)
+            return None
+        match = re.search(r'version (\d+)\.(\d+)', out)
+        if not match:
+            LOG.warning("Unable to parse the dnsmasq version from: %s", out)
+            return None
+        version = (int(match.group(1)), int(match.group(2)))
+        LOG.info("Found dnsmasq version %d.%d, hostsdir mode %s",
+                 version[0], version[1],
+                 'supported' if version >= cls.MINIMUM_HOSTSDIR_VERSION
+                 else 'not supported')
+        return version
+
+    @property
+    def use_hostsdir(self):
+        """Whether hosts and options are written as one file per port."""
+        return bool(self.conf.dnsmasq_use_hostsdir and self.version and
+                    tuple(self.version) >= self.MINIMUM_HOSTSDIR_VERSION)
 
     @classmethod
     def existing_dhcp_networks(cls, conf):
@@ -297,12 +924,38 @@ class Dnsmasq(DhcpLocalProcess):
             '--interface=%s' % self.interface_name,
             '--except-interface=lo',
             '--pid-file=%s' % pid_file,
-            '--dhcp-hostsfile=%s' % self.get_conf_file_name('host'),
-            '--addn-hosts=%s' % self.get_conf_file_name('addn_hosts'),
+        ]
+        if self.use_hostsdir:
+            cmd += [
+                '--dhcp-hostsdir=%s' % self.get_conf_file_name('hostsdir'),
+                '--hostsdir=%s' % self.get_conf_file_name('addn_hostsdir'),
+                '--dhcp-optsdir=%s' % self.get_conf_file_name('optsdir'),
+            ]
+        else:
+            cmd += [
+                '--dhcp-hostsfile=%s' % self.get_conf_file_name('host'),
+                '--addn-hosts=%s' % self.get_conf_file_name('addn_hosts'),
+            ]
+        cmd += [
             '--dhcp-optsfile=%s' % self.get_conf_file_name('opts'),
             '--dhcp-leasefile=%s' % self.get_conf_file_name('leases'),
         ]
 
+        range_args, possible_leases = self._build_dhcp_range_args()
+        cmd += range_args
+        cmd += self._build_mtu_args()
+
+        # Cap the limit because creating lots of subnets can inflate
+        # this possible lease cap.
+        cmd.append('--dhcp-lease-max=%d' %
+                   min(possible_leases, self.conf.dnsmasq_lease_max))
+
+        cmd += self._build_server_args(self.conf)
+        return cmd
+
+    def _build_dhcp_range_args(self):
+        """Return the --dhcp-range arguments and the leases they allow."""
+        args = []
         possible_leases = 0
         for i, subnet in enumerate(self.network.subnets):
             mode = None
@@ -321,7 +974,7 @@ class Dnsmasq(DhcpLocalProcess):
                         not addr_mode and not ra_mode):
                     mode = 'static'
 
-            cidr = netaddr.IPNetwork(subnet.cidr)
+            cidr = addr_cache.network(subnet.cidr)
 
             if self.conf.dhcp_lease_duration == -1:
                 lease = 'infinite'
@@ -331,76 +984,284 @@ class Dnsmasq(DhcpLocalProcess):
             # mode is optional and is not set - skip it
             if mode:
                 if subnet.ip_version == 4:
-                    cmd.append('--dhcp-range=%s%s,%s,%s,%s' %
-                               ('set:', self._TAG_PREFIX % i,
-                                cidr.network, mode, lease))
+                    args.append('--dhcp-range=%s%s,%s,%s,%s' %
+                                ('set:', self._subnet_tag(i),
+                                 cidr.network, mode, lease))
                 else:
-                    cmd.append('--dhcp-range=%s%s,%s,%s,%d,%s' %
-                               ('set:', self._TAG_PREFIX % i,
-                                cidr.network, mode,
-                                cidr.prefixlen, lease))
+                    args.append('--dhcp-range=%s%s,%s,%s,%d,%s' %
+                                ('set:', self._subnet_tag(i),
+                                 cidr.network, mode,
+                                 cidr.prefixlen, lease))
                 possible_leases += cidr.size
+        return args, possible_leases
 
+    def _build_mtu_args(self):
         if cfg.CONF.advertise_mtu:
             mtu = self.network.mtu
             # Do not advertise unknown mtu
             if mtu > 0:
-                cmd.append('--dhcp-option-force=option:mtu,%d' % mtu)
+                return ['--dhcp-option-force=option:mtu,%d' % mtu]
+        return []
 
-        # Cap the limit because creating lots of subnets can inflate
-        # this possible lease cap.
-        cmd.append('--dhcp-lease-max=%d' %
-                   min(possible_leases, self.conf.dnsmasq_lease_max))
-
-        cmd.append('--conf-file=%s' % self.conf.dnsmasq_config_file)
-        if self.conf.dnsmasq_dns_servers:
-            cmd.extend(
+    @staticmethod
+    def _build_server_args(conf):
+        """Return the arguments which do not depend on the network."""
+        args = ['--conf-file=%s' % conf.dnsmasq_config_file]
+        if conf.dnsmasq_dns_servers:
+            args.extend(
                 '--server=%s' % server
-                for server in self.conf.dnsmasq_dns_servers)
+                for server in conf.dnsmasq_dns_servers)
 
-        if self.conf.dhcp_domain:
-            cmd.append('--domain=%s' % self.conf.dhcp_domain)
+        if conf.dhcp_domain:
+            args.append('--domain=%s' % conf.dhcp_domain)
 
-        if self.conf.dhcp_broadcast_reply:
-            cmd.append('--dhcp-broadcast')
+        if conf.dhcp_broadcast_reply:
+            args.append('--dhcp-broadcast')
+        return args
 
-        return cmd
+    def _subnet_tag(self, index):
+        """Return the dnsmasq tag of the index-th subnet of the network."""
+        return self._TAG_PREFIX % index
+
+    def classify_change(self, old_network):
+        """Compare the models, then the command line of dnsmasq.
+
+        dnsmasq reads files on a HUP, but DHCP ranges, the lease cap, the
+        MTU and its files and interface only from its command line, so a
+        restart is only needed when the command line dnsmasq would now be
+        started with differs from the one it runs with.
+        """
+        change = classify_network_change(old_network, self.network)
+        if (change != CHANGE_RESTART and self.active and
+                self._cmdline_changed()):
+            change = CHANGE_RESTART
+        return change
+
+    def _cmdline_changed(self):
+        pm = self._get_process_manager()
+        return pm.cmdline != self._build_cmdline_callback(
+            pm.get_pid_file_name())
 
     def spawn_process(self):
         """Spawn the process, if it's not spawned already."""
+        files, allocations = self._render_config_files()
         # we only need to generate the lease file the first time dnsmasq starts
         # rather than on every reload since dnsmasq will keep the file current
-        self._output_init_lease_file()
-        self._spawn_or_reload_process(reload_with_HUP=False)
+        self._output_init_lease_file(files)
+        self._spawn_or_reload_process(reload_with_HUP=False, files=files)
 
-    def _spawn_or_reload_process(self, reload_with_HUP):
+    def _spawn_or_reload_process(self, reload_with_HUP, files=None):
         """Spawns or reloads a Dnsmasq process for the network.
 
         When reload_with_HUP is True, dnsmasq receives a HUP signal,
-        or it's reloaded if the process is not running.
+        or it's reloaded if the process is not running.  The HUP is skipped
+        when none of the config files changed and dnsmasq is running.
+
+        Returns False if the reload was skipped, True otherwise.
         """
 
-        self._output_config_files()
+        needs_reload = self._output_config_files(files)
 
         pm = self._get_process_manager(
             cmd_callback=self._build_cmdline_callback)
 
+        if reload_with_HUP and not needs_reload and pm.active:
+            self.reload_stats['skipped'] += 1
+            LOG.debug('Config files of network %s are unchanged, not '
+                      'reloading dnsmasq', self.network.id)
+            return False
+
         pm.enable(reload_cfg=reload_with_HUP)
+        if reload_with_HUP:
+            self.reload_stats['performed'] += 1
 
-        self.process_monitor.register(uuid=self.network.id,
+        self.process_monitor.register(uuid=pm.uuid,
                                       service_name=DNSMASQ_SERVICE_NAME,
                                       monitored_process=pm)
+        return True
 
     def _release_lease(self, mac_address, ip):
         """Release a DHCP lease."""
         cmd = ['dhcp_release', self.interface_name, ip, mac_address]
-        ip_wrapper = ip_lib.IPWrapper(namespace=self.network.namespace)
+        ip_wrapper = ip_lib.IPWrapper(namespace=self.namespace)
         ip_wrapper.netns.execute(cmd, run_as_root=True)
 
-    def _output_config_files(self):
-        self._output_hosts_file()
-        self._output_addn_hosts_file()
-        self._output_opts_file()
+    def _release_leases(self, leases):
+        """Release (ip_address, mac_address) leases, batched if enabled.
+
+        The batch runs dhcp_release_batch once in the namespace of the
+        network; if it cannot be run the leases are released one by one.
+        """
+        if not leases:
+            return
+        started = time.time()
+        released = False
+        if self.conf.dhcp_release_batch:
+            cmd = ['dhcp_release_batch',
+                   '--backend=%s' % self.conf.dhcp_release_backend,
+                   self.interface_name]
+            process_input = ''.join('%s %s\n' % (ip, mac)
+                                    for ip, mac in leases)
+            ip_wrapper = ip_lib.IPWrapper(namespace=self.namespace)
+            try:
+                out = ip_wrapper.netns.execute(
+                    cmd, process_input=process_input, run_as_root=True,
+                    extra_ok_codes=[RELEASE_BATCH_PARTIAL_FAILURE])
+                LOG.debug('dhcp_release_batch: %s', out.strip())
+                released = True
+            except RuntimeError:
+                LOG.warning('Batched lease release failed for network %s, '
+                            'releasing leases one by one', self.network.id)
+        if not released:
+            for ip, mac in leases:
+                self._release_lease(mac, ip)
+
+        finished = time.time()
+        elapsed = finished - started
+        stats = self.release_stats
+        stats['batches'] += 1
+        stats['leases'] += len(leases)
+        stats['time'] += elapsed
+        stats['last_batch_leases'] = len(leases)
+        stats['last_batch_time'] = elapsed
+        stats['last_batch_at'] = finished
+        LOG.info('Released %(count)d leases of network %(net)s in '
+                 '%(time).3fs', {'count': len(leases),
+                                 'net': self.network.id, 'time': elapsed})
+
+    def _output_config_files(self, files=None):
+        """Write the host, addn_hosts and opts files which changed.
+
+        files is the first result of _render_config_files(); the network is
+        rendered here when it is not given.  A file is only replaced when
+        its digest differs from the one last written for the network.  In
+        hostsdir mode only the opts file is shared, the per-port files are
+        written by _output_port_files().
+
+        Returns True if dnsmasq has to reload to see the changes.
+        """
+        if files is None:
+            files, allocations = self._render_config_files()
+        digests = config_digests.setdefault(self.network.id, {})
+        changed = []
+        needs_reload = False
+        if self.use_hostsdir:
+            kinds = ('opts',)
+            needs_reload = self._output_port_files(files)
+        else:
+            kinds = ('host', 'addn_hosts', 'opts')
+        for kind in kinds:
+            filename = self.get_conf_file_name(kind)
+            digest = _digest(files[kind])
+            if digests.get(kind) == digest and os.path.exists(filename):
+                continue
+            utils.replace_file(filename, files[kind])
+            digests[kind] = digest
+            changed.append(kind)
+        LOG.debug('Done building config files for network %(net)s, '
+                  'changed: %(changed)s',
+                  {'net': self.network.id, 'changed': changed})
+        return needs_reload or bool(changed)
+
+    # prepended to the port id to name the files of a port
+    _port_file_prefix = ''
+
+    def _port_file_name(self, kind, port_id):
+        return os.path.join(self.get_conf_file_name(kind),
+                            self._port_file_prefix + port_id)
+
+    def _port_changes(self, files):
+        """Diff the rendered ports against the files last written.
+
+        Returns (written, added, changed, removed): the port_file_state
+        entry of the network and the ids of the ports whose files are new,
+        differ or are gone.  The diff is kept in files so lease release
+        and the file writes of one reload share it.
+        """
+        if 'port_changes' in files:
+            return files['port_changes']
+        ports = files['ports']
+        written = port_file_state.get(self.network.id)
+        if written is None:
+            written = self._read_port_file_state()
+        added = []
+        changed = []
+        for port_id, fragments in six.iteritems(ports):
+            old = written.get(port_id)
+            if old is None:
+                added.append(port_id)
+            elif old is not fragments and old != fragments:
+                changed.append(port_id)
+        removed = [port_id for port_id in written if port_id not in ports]
+        files['port_changes'] = (written, added, changed, removed)
+        return files['port_changes']
+
+    def _read_port_file_state(self):
+        """Rebuild what is known about the port files already on disk.
+
+        Only the allocations can be recovered, so every port found is
+        rewritten once.
+        """
+        written = {}
+        prefix = self._port_file_prefix
+        try:
+            port_ids = [name[len(prefix):] for name in
+                        os.listdir(self.get_conf_file_name('hostsdir'))
+                        if name.startswith(prefix) and
+                        not name.startswith('.')]
+        except OSError:
+            return written
+        for port_id in port_ids:
+            allocations = self._read_hosts_file_leases(
+                self._port_file_name('hostsdir', port_id))
+            written[port_id] = _PortFragments(None, None, [], None,
+                                              tuple(allocations), None)
+        return written
+
+    def _output_port_files(self, files):
+        """Write the files of new and changed ports, remove deleted ones.
+
+        dnsmasq picks up new files on its own, but keeps the entries of
+        changed and deleted files until it is reloaded.
+
+        Returns True if dnsmasq has to reload.
+        """
+        written, added, changed, removed = self._port_changes(files)
+        ports = files['ports']
+        for kind, dir_kind in self.PORT_DIRS:
+            utils.ensure_dir(self.get_conf_file_name(dir_kind))
+        for port_id in added + changed:
+            fragments = ports[port_id]
+            options = ''
+            if fragments.opts_tag is None:
+                options = ''.join('%s\n' % option
+                                  for option in fragments.options)
+            for contents, (kind, dir_kind) in zip(
+                    (fragments.hosts, fragments.addn_hosts, options),
+                    self.PORT_DIRS):
+                # dnsmasq ignores dot files, it must not read the tempfile
+                utils.replace_file(self._port_file_name(dir_kind, port_id),
+                                   contents, tmp_prefix='.')
+            written[port_id] = fragments
+        for port_id in removed:
+            for kind, dir_kind in self.PORT_DIRS:
+                try:
+                    os.remove(self._port_file_name(dir_kind, port_id))
+                except OSError:
+                    pass
+            del written[port_id]
+        port_file_state[self.network.id] = written
+        if added or changed or removed:
+            LOG.debug('Port files of network %(net)s: %(added)d added, '
+                      '%(changed)d changed, %(removed)d removed',
+                      {'net': self.network.id, 'added': len(added),
+                       'changed': len(changed), 'removed': len(removed)})
+        return bool(changed or removed)
+
+    def _hostsdir_mode_changed(self):
+        """Whether the running dnsmasq was started in the other mode."""
+        return (os.path.isdir(self.get_conf_file_name('hostsdir')) !=
+                self.use_hostsdir)
 
     def reload_allocations(self):
         """Rebuild the dnsmasq config and signal the dnsmasq to reload."""
@@ -412,13 +1273,24 @@ class Dnsmasq(DhcpLocalProcess):
                       'turned off DHCP: %s', self.network.id)
             return
 
-        self._release_unused_leases()
-        self._spawn_or_reload_process(reload_with_HUP=True)
+        # switching between single file and hostsdir mode changes the
+        # command line
+        if self.active and self._hostsdir_mode_changed():
+            LOG.debug('Restarting dnsmasq for network %s to switch the '
+                      'hostsdir mode', self.network.id)
+            self.restart()
+            return
+
+        files, allocations = self._render_config_files()
+        self._release_unused_leases(files, allocations)
+        if not self._spawn_or_reload_process(reload_with_HUP=True,
+                                             files=files):
+            return
         LOG.debug('Reloading allocations for network: %s interface_name:%s',
                                             self.network.id, self.interface_name)
         self.device_manager.update(self.network, self.interface_name)
 
-    def _sort_fixed_ips_for_dnsmasq(self, fixed_ips, v6_nets):
+    def _sort_fixed_ips_for_dnsmasq(self, fixed_ips, stateless_subnet_ids):
         """Sort fixed_ips so that stateless IPv6 subnets appear first.
 
         For example, If a port with v6 extra_dhcp_opts is on a network with
@@ -449,69 +1321,46 @@ class Dnsmasq(DhcpLocalProcess):
         so that entry for stateless IPv6 comes first,
         then dnsmasq can correctly fetch the IPv4 address.
         """
+        # nothing to reorder for the common single address port
+        if not stateless_subnet_ids or len(fixed_ips) < 2:
+            return fixed_ips
         return sorted(
             fixed_ips,
-            key=lambda fip: ((fip.subnet_id in v6_nets) and (
-                v6_nets[fip.subnet_id].ipv6_address_mode == (
-                    constants.DHCPV6_STATELESS))),
+            key=lambda fip: fip.subnet_id in stateless_subnet_ids,
             reverse=True)
 
-    def _iter_hosts(self):
-        """Iterate over hosts.
-
-        For each host on the network we yield a tuple containing:
-        (
-            port,  # a DictModel instance representing the port.
-            alloc,  # a DictModel instance of the allocated ip and subnet.
-                    # if alloc is None, it means there is no need to allocate
-                    # an IPv6 address because of stateless DHCPv6 network.
-            host_name,  # Host name.
-            name,  # Canonical hostname in the format 'hostname[.domain]'.
-            no_dhcp,  # A flag indicating that the address doesn't need a DHCP
-                      # IP address.
-            no_opts,  # A flag indication that options shouldn't be written
-        )
-        """
-        v6_nets = dict((subnet.id, subnet) for subnet in
-                       self.network.subnets if subnet.ip_version == 6)
-
-        for port in self.network.ports:
-            fixed_ips = self._sort_fixed_ips_for_dnsmasq(port.fixed_ips,
-                                                         v6_nets)
-            for alloc in fixed_ips:
-                no_dhcp = False
-                no_opts = False
-                if alloc.subnet_id in v6_nets:
-                    addr_mode = v6_nets[alloc.subnet_id].ipv6_address_mode
-                    no_dhcp = addr_mode in (constants.IPV6_SLAAC,
-                                            constants.DHCPV6_STATELESS)
-                    # we don't setup anything for SLAAC. It doesn't make sense
-                    # to provide options for a client that won't use DHCP
-                    no_opts = addr_mode == constants.IPV6_SLAAC
-
-                hostname = 'host-%s' % alloc.ip_address.replace(
-                    '.', '-').replace(':', '-')
-                fqdn = hostname
-                if self.conf.dhcp_domain:
-                    fqdn = '%s.%s' % (fqdn, self.conf.dhcp_domain)
-                yield (port, alloc, hostname, fqdn, no_dhcp, no_opts)
-
-    def _output_init_lease_file(self):
-        """Write a fake lease file to bootstrap dnsmasq.
-
-        The generated file is passed to the --dhcp-leasefile option of dnsmasq.
-        This is used as a bootstrapping mechanism to avoid NAKing active leases
-        when a dhcp server is scheduled to another agent. Using a leasefile
-        will also prevent dnsmasq from NAKing or ignoring renewals after a
-        restart.
-
-        Format is as follows:
-        epoch-timestamp mac_addr ip_addr hostname client-ID
+    def _render_config_files(self):
+        """Render all dnsmasq files of the network in a single pass.
+
+        Returns a (files, allocations) tuple.  files maps 'host',
+        'addn_hosts', 'opts' and 'leases' to their contents, in hostsdir
+        mode 'ports' maps port ids to their fragments instead of 'host' and
+        'addn_hosts', and 'opts' holds the network wide options only:
+
+        host        'mac_address,FQDN,ip_address' lines for the hosts which
+                    should receive a dhcp lease, sent to --dhcp-hostsfile.
+                    A dnsmasq instance does not resolve hosts defined in
+                    this file if it did not give a lease to a host listed in
+                    it, resolution is defined by addn_hosts.
+        addn_hosts  /etc/hosts style lines for every allocation, sent to
+                    --addn-hosts.
+        opts        subnet and port options, sent to --dhcp-optsfile.
+        leases      fake leases used to bootstrap dnsmasq, see
+                    _output_init_lease_file.
+
+        allocations is the set of (ip_address, mac_address) of every port
+        but the DHCP port, used to find leases which must be released.
         """
-        filename = self.get_conf_file_name('leases')
-        buf = six.StringIO()
+        subnets = self.network.subnets
+        context = _RenderContext(
+            self.conf.dhcp_domain,
+            frozenset(s.id for s in subnets if s.enable_dhcp),
+            dict((s.id, s.ipv6_address_mode) for s in subnets
+                 if s.ip_version == 6))
+        stateless_subnet_ids = set(
+            subnet_id for subnet_id, mode in six.iteritems(context.v6_modes)
+            if mode == constants.DHCPV6_STATELESS)
 
-        LOG.debug('Building initial lease file: %s', filename)
         # we make up a lease time for the database entry
         if self.conf.dhcp_lease_duration == -1:
             # Even with an infinite lease, a client may choose to renew a
@@ -521,26 +1370,167 @@ class Dnsmasq(DhcpLocalProcess):
             timestamp = 0
         else:
             timestamp = int(time.time()) + self.conf.dhcp_lease_duration
-        dhcp_enabled_subnet_ids = [s.id for s in self.network.subnets
-                                   if s.enable_dhcp]
-        for host_tuple in self._iter_hosts():
-            port, alloc, hostname, name, no_dhcp, no_opts = host_tuple
-            # don't write ip address which belongs to a dhcp disabled subnet
-            # or an IPv6 SLAAC/stateless subnet
-            if port.device_owner == 'network:dhcp':
+
+        use_hostsdir = self.use_hostsdir
+        hosts = []
+        addn_hosts = []
+        leases = []
+        ports = {}
+        port_options = []
+        dhcp_ports = []
+        allocations = set()
+        # size in lines and bytes of each shared option set written
+        option_sets = {}
+        shared_ports = 0
+        lines_saved = 0
+        bytes_saved = 0
+
+        # NOTE(ihrachyshka): the loop should not log anything inside it, to
+        # avoid potential performance drop when lots of hosts are dumped
+        for port in self.network.ports:
+            if port.device_owner == constants.DEVICE_OWNER_DHCP:
+                if getattr(port, 'extra_dhcp_opts', False):
+                    port_options.extend(self._generate_opts_for_port(port))
+                dhcp_ports.append(port)
+                continue
+
+            fragments = port_fragments.get(port, context)
+            if fragments is None:
+                fragments = self._render_port(port, context,
+                                              stateless_subnet_ids)
+                port_fragments.put(port, context, fragments)
+            if fragments.opts_tag is not None:
+                shared_ports += 1
+                size = option_sets.get(fragments.opts_tag)
+                if size is None:
+                    option_sets[fragments.opts_tag] = (
+                        len(fragments.options),
+                        sum(len(option) + 1 for option in fragments.options))
+                    port_options.extend(fragments.options)
+                else:
+                    lines_saved += size[0]
+                    bytes_saved += size[1]
+            if use_hostsdir:
+                ports[port.id] = fragments
+            else:
+                hosts.append(fragments.hosts)
+                addn_hosts.append(fragments.addn_hosts)
+                if fragments.opts_tag is None:
+                    port_options.extend(fragments.options)
+            leases.extend(fragments.leases)
+            allocations.update(fragments.allocations)
+
+        options, subnet_index_map = self._generate_opts_per_subnet(
+            dhcp_ports)
+        options.extend(port_options)
+        # provides all dnsmasq ip as dns-server if there is more than one
+        # dnsmasq for a subnet and there is no dns-server submitted by the
+        # server
+        dhcp_ips = collections.defaultdict(list)
+        for port in dhcp_ports:
+            for ip in port.fixed_ips:
+                i = subnet_index_map.get(ip.subnet_id)
+                if i is not None:
+                    dhcp_ips[i].append(ip.ip_address)
+        options.extend(self._generate_dhcp_server_opts(dhcp_ips))
+        if shared_ports:
+            self.option_set_stats = {
+                'ports': shared_ports, 'sets': len(option_sets),
+                'lines_saved': lines_saved, 'bytes_saved': bytes_saved}
+        else:
+            self.option_set_stats = None
+        lease_prefix = '%s ' % timestamp
+        files = {'opts': '\n'.join(options),
+                 'leases': ''.join([lease_prefix + lease
+                                    for lease in leases])}
+        if use_hostsdir:
+            files['ports'] = ports
+        else:
+            files['host'] = ''.join(hosts)
+            files['addn_hosts'] = ''.join(addn_hosts)
+        return files, allocations
+
+    def _render_port(self, port, context, stateless_subnet_ids):
+        """Render the lines a port contributes to the dnsmasq files."""
+        hosts = []
+        addn_hosts = []
+        leases = []
+        allocations = []
+        extra_dhcp_opts = getattr(port, 'extra_dhcp_opts', False)
+        options = []
+        opts_tag = None
+        tag = port.id
+        if extra_dhcp_opts:
+            opts_tag, options = self._generate_shared_opts_for_port(port)
+            tag = opts_tag or tag
+        mac_address = port.mac_address
+        for alloc in self._sort_fixed_ips_for_dnsmasq(port.fixed_ips,
+                                                      stateless_subnet_ids):
+            allocations.append((alloc.ip_address, mac_address))
+            hostname = 'host-%s' % alloc.ip_address.replace(
+                '.', '-').replace(':', '-')
+            fqdn = hostname
+            if context.dhcp_domain:
+                fqdn = '%s.%s' % (fqdn, context.dhcp_domain)
+            # It is compulsory to write the `fqdn` before the `hostname` in
+            # order to obtain it in PTR responses.
+            addn_hosts.append('%s\t%s %s\n' %
+                              (alloc.ip_address, fqdn, hostname))
+
+            addr_mode = context.v6_modes.get(alloc.subnet_id)
+            if addr_mode in (constants.IPV6_SLAAC,
+                             constants.DHCPV6_STATELESS):
+                # we don't setup anything for SLAAC. It doesn't make sense
+                # to provide options for a client that won't use DHCP
+                if extra_dhcp_opts and addr_mode != constants.IPV6_SLAAC:
+                    hosts.append('%s,%s%s\n' %
+                                 (mac_address, 'set:', tag))
                 continue
-            if no_dhcp or alloc.subnet_id not in dhcp_enabled_subnet_ids:
+
+            # don't write ip address which belongs to a dhcp disabled subnet.
+            if alloc.subnet_id not in context.dhcp_enabled_subnet_ids:
                 continue
 
             ip_address = self._format_address_for_dnsmasq(alloc.ip_address)
+            if extra_dhcp_opts:
+                hosts.append('%s,%s,%s,%s%s\n' %
+                             (mac_address, fqdn, ip_address,
+                              'set:', tag))
+            else:
+                hosts.append('%s,%s,%s\n' %
+                             (mac_address, fqdn, ip_address))
             # all that matters is the mac address and IP. the hostname and
             # client ID will be overwritten on the next renewal.
-            buf.write('%s %s %s * *\n' %
-                      (timestamp, port.mac_address, ip_address))
-        contents = buf.getvalue()
-        utils.replace_file(filename, contents)
-        LOG.debug('Done building initial lease file %s with contents:\n%s',
-                  filename, contents)
+            leases.append('%s %s * *\n' % (mac_address, ip_address))
+
+        return _PortFragments(''.join(hosts), ''.join(addn_hosts), leases,
+                              options, tuple(allocations), opts_tag)
+
+    def _stale_port_leases(self, files, allocations):
+        """Return the allocations of changed and removed ports now gone."""
+        written, added, changed, removed = self._port_changes(files)
+        stale_leases = set()
+        for port_id in changed + removed:
+            stale_leases.update(written[port_id].allocations)
+        return stale_leases - allocations
+
+    def _output_init_lease_file(self, files=None):
+        """Write a fake lease file to bootstrap dnsmasq.
+
+        The generated file is passed to the --dhcp-leasefile option of dnsmasq.
+        This is used as a bootstrapping mechanism to avoid NAKing active leases
+        when a dhcp server is scheduled to another agent. Using a leasefile
+        will also prevent dnsmasq from NAKing or ignoring renewals after a
+        restart.
+
+        Format is as follows:
+        epoch-timestamp mac_addr ip_addr hostname client-ID
+        """
+        if files is None:
+            files, allocations = self._render_config_files()
+        filename = self.get_conf_file_name('leases')
+        utils.replace_file(filename, files['leases'])
+        LOG.debug('Done building initial lease file %s', filename)
         return filename
 
     @staticmethod
@@ -548,240 +1538,179 @@ class Dnsmasq(DhcpLocalProcess):
         # (dzyu) Check if it is legal ipv6 address, if so, need wrap
         # it with '[]' to let dnsmasq to distinguish MAC address from
         # IPv6 address.
-        if netaddr.valid_ipv6(address):
+        if addr_cache.is_ipv6(address):
             return '[%s]' % address
         return address
 
-    def _output_hosts_file(self):
-        """Writes a dnsmasq compatible dhcp hosts file.
-
-        The generated file is sent to the --dhcp-hostsfile option of dnsmasq,
-        and lists the hosts on the network which should receive a dhcp lease.
-        Each line in this file is in the form::
-
-            'mac_address,FQDN,ip_address'
-
-        IMPORTANT NOTE: a dnsmasq instance does not resolve hosts defined in
-        this file if it did not give a lease to a host listed in it (e.g.:
-        multiple dnsmasq instances on the same network if this network is on
-        multiple network nodes). This file is only defining hosts which
-        should receive a dhcp lease, the hosts resolution in itself is
-        defined by the `_output_addn_hosts_file` method.
-        """
-        buf = six.StringIO()
-        filename = self.get_conf_file_name('host')
-
-        LOG.debug('Building host file: %s', filename)
-        dhcp_enabled_subnet_ids = [s.id for s in self.network.subnets
-                                   if s.enable_dhcp]
-        # NOTE(ihrachyshka): the loop should not log anything inside it, to
-        # avoid potential performance drop when lots of hosts are dumped
-        for host_tuple in self._iter_hosts():
-            port, alloc, hostname, name, no_dhcp, no_opts = host_tuple
-            if port.device_owner == 'network:dhcp':
-                continue
-            if no_dhcp:
-                if not no_opts and getattr(port, 'extra_dhcp_opts', False):
-                    buf.write('%s,%s%s\n' %
-                              (port.mac_address, 'set:', port.id))
-                continue
-
-            # don't write ip address which belongs to a dhcp disabled subnet.
-            if alloc.subnet_id not in dhcp_enabled_subnet_ids:
-                continue
-
-            ip_address = self._format_address_for_dnsmasq(alloc.ip_address)
-
-            if getattr(port, 'extra_dhcp_opts', False):
-                buf.write('%s,%s,%s,%s%s\n' %
-                          (port.mac_address, name, ip_address,
-                           'set:', port.id))
-            else:
-                buf.write('%s,%s,%s\n' %
-                          (port.mac_address, name, ip_address))
-
-        utils.replace_file(filename, buf.getvalue())
-        LOG.debug('Done building host file %s', filename)
-        return filename
-
     def _read_hosts_file_leases(self, filename):
         leases = set()
         if os.path.exists(filename):
             with open(filename) as f:
                 for l in f.readlines():
                     host = l.strip().split(',')
+                    # 'mac,set:tag' lines of stateless subnets hold no IP
+                    if len(host) < 3:
+                        continue
                     leases.add((host[2].strip('[]'), host[0]))
         return leases
 
-    def _release_unused_leases(self):
-        filename = self.get_conf_file_name('host')
-        old_leases = self._read_hosts_file_leases(filename)
-
-        new_leases = set()
-        for port in self.network.ports:
-            LOG.debug("port:%s", port)
-            for alloc in port.fixed_ips:
-                if port.device_owner != 'network:dhcp':
-                    new_leases.add((alloc.ip_address, port.mac_address))
-
-        if old_leases == new_leases:
-            LOG.debug("old_leases == new_leases")
-            return
-
-        self._output_init_lease_file()
-        for ip, mac in old_leases - new_leases:
-            LOG.debug("IP:%s, MAC:%s", ip, mac)
+    def _release_unused_leases(self, files=None, allocations=None):
+        if files is None:
+            files, allocations = self._render_config_files()
+        if 'ports' in files:
+            stale_leases = self._stale_port_leases(files, allocations)
+            if not stale_leases:
+                return
+        else:
+            filename = self.get_conf_file_name('host')
+            old_leases = self._read_hosts_file_leases(filename)
 
-            self._release_lease(mac, ip)
+            if old_leases == allocations:
+                LOG.debug("old_leases == new_leases")
+                return
+            stale_leases = old_leases - allocations
 
+        self._output_init_lease_file(files)
+        self._release_leases(stale_leases)
 
-    def _output_addn_hosts_file(self):
-        """Writes a dnsmasq compatible additional hosts file.
+    def _generate_opts_per_subnet(self, dhcp_ports):
+        """Return the subnet options and the subnets using dnsmasq as DNS.
 
-        The generated file is sent to the --addn-hosts option of dnsmasq,
-        and lists the hosts on the network which should be resolved even if
-        the dnsmaq instance did not give a lease to the host (see the
-        `_output_hosts_file` method).
-        Each line in this file is in the same form as a standard /etc/hosts
-        file.
+        The options of each subnet are rendered once and kept in
+        subnet_options until the subnet or the CIDRs of its network
+        change, so port updates reuse them as they are.
         """
-        buf = six.StringIO()
-        for host_tuple in self._iter_hosts():
-            port, alloc, hostname, fqdn, no_dhcp, no_opts = host_tuple
-            # It is compulsory to write the `fqdn` before the `hostname` in
-            # order to obtain it in PTR responses.
-            if port.device_owner == 'network:dhcp':
-                continue
-            if alloc:
-                buf.write('%s\t%s %s\n' % (alloc.ip_address, fqdn, hostname))
-        addn_hosts = self.get_conf_file_name('addn_hosts')
-        utils.replace_file(addn_hosts, buf.getvalue())
-        return addn_hosts
-
-    def _output_opts_file(self):
-        """Write a dnsmasq compatible options file."""
-        options, subnet_index_map = self._generate_opts_per_subnet()
-        options += self._generate_opts_per_port(subnet_index_map)
-
-        name = self.get_conf_file_name('opts')
-        utils.replace_file(name, '\n'.join(options))
-        return name
-
-    def _generate_opts_per_subnet(self):
         options = []
         subnet_index_map = {}
-        if self.conf.enable_isolated_metadata:
-            subnet_to_interface_ip = self._make_subnet_interface_ip_map()
-        isolated_subnets = self.get_isolated_subnets(self.network)
+        isolated_metadata = self.conf.enable_isolated_metadata
+        if isolated_metadata:
+            subnet_to_interface_ip = self._make_subnet_interface_ip_map(
+                dhcp_ports)
+            isolated_subnets = self.get_isolated_subnets(self.network)
+        v4_cidrs = tuple(s.cidr for s in self.network.subnets
+                         if s.ip_version == 4)
         for i, subnet in enumerate(self.network.subnets):
-            LOG.debug("subnet:%s", subnet)
             addr_mode = getattr(subnet, 'ipv6_address_mode', None)
             if (not subnet.enable_dhcp or
                 (subnet.ip_version == 6 and
                  addr_mode == constants.IPV6_SLAAC)):
                 continue
-            if subnet.dns_nameservers:
-                options.append(
-                    self._format_option(
-                        subnet.ip_version, i, 'dns-server',
-                        ','.join(
-                            Dnsmasq._convert_to_literal_addrs(
-                                subnet.ip_version, subnet.dns_nameservers))))
-            else:
+            if not subnet.dns_nameservers:
                 # use the dnsmasq ip as nameservers only if there is no
                 # dns-server submitted by the server
                 subnet_index_map[subnet.id] = i
 
-            if self.conf.dhcp_domain and subnet.ip_version == 6:
-                options.append('tag:tag%s,option6:domain-search,%s' %
-                               (i, ''.join(self.conf.dhcp_domain)))
-
-            gateway = subnet.gateway_ip
-            host_routes = []
-            for hr in subnet.host_routes:
-                LOG.debug("subnet.host_routes:%s", hr)
-                if hr.destination == constants.IPv4_ANY:
-                    if not gateway:
-                        gateway = hr.nexthop
-                else:
-                    host_routes.append("%s,%s" % (hr.destination, hr.nexthop))
-
             # Add host routes for isolated network segments
+            metadata_ip = None
+            if (isolated_metadata and subnet.ip_version == 4 and
+                    isolated_subnets[subnet.id]):
+                metadata_ip = subnet_to_interface_ip[subnet.id]
+
+            context = (self._subnet_tag(i), v4_cidrs, metadata_ip,
+                       self.conf.dhcp_domain)
+            block = subnet_options.get(subnet, context)
+            if block is None:
+                block = self._generate_subnet_opts(i, subnet, v4_cidrs,
+                                                   metadata_ip)
+                subnet_options.put(subnet, context, block)
+            options.extend(block)
+        return options, subnet_index_map
 
-            if (isolated_subnets[subnet.id] and
-                    self.conf.enable_isolated_metadata and
-                    subnet.ip_version == 4):
-                subnet_dhcp_ip = subnet_to_interface_ip[subnet.id]
-                host_routes.append(
-                    '%s/32,%s' % (METADATA_DEFAULT_IP, subnet_dhcp_ip)
-                )
+    def _generate_subnet_opts(self, i, subnet, v4_cidrs, metadata_ip):
+        """Render the options of the i-th subnet of the network."""
+        options = []
+        LOG.debug("subnet:%s", subnet)
+        if subnet.dns_nameservers:
+            options.append(
+                self._format_option(
+                    subnet.ip_version, i, 'dns-server',
+                    ','.join(
+                        Dnsmasq._convert_to_literal_addrs(
+                            subnet.ip_version, subnet.dns_nameservers))))
+
+        if self.conf.dhcp_domain and subnet.ip_version == 6:
+            options.append('tag:%s,option6:domain-search,%s' %
+                           (self._subnet_tag(i),
+                            ''.join(self.conf.dhcp_domain)))
+
+        gateway = subnet.gateway_ip
+        host_routes = []
+        for hr in subnet.host_routes:
+            LOG.debug("subnet.host_routes:%s", hr)
+            if hr.destination == constants.IPv4_ANY:
+                if not gateway:
+                    gateway = hr.nexthop
+            else:
+                host_routes.append("%s,%s" % (hr.destination, hr.nexthop))
 
-            if subnet.ip_version == 4:
-                host_routes.extend(["%s,0.0.0.0" % (s.cidr) for s in
-                                    self.network.subnets
-                                    if (s.ip_version == 4 and
-                                        s.cidr != subnet.cidr)])
-
-                if host_routes:
-                    LOG.debug("host_routes:%s", host_routes)
-                    if gateway:
-                        host_routes.append("%s,%s" % (constants.IPv4_ANY,
-                                                      gateway))
-                    options.append(
-                        self._format_option(subnet.ip_version, i,
-                                            'classless-static-route',
-                                            ','.join(host_routes)))
-                    options.append(
-                        self._format_option(subnet.ip_version, i,
-                                            WIN2k3_STATIC_DNS,
-                                            ','.join(host_routes)))
+        if metadata_ip:
+            host_routes.append('%s/32,%s' % (METADATA_DEFAULT_IP, metadata_ip))
+
+        if subnet.ip_version == 4:
+            host_routes.extend(["%s,0.0.0.0" % cidr for cidr in v4_cidrs
+                                if cidr != subnet.cidr])
 
+            if host_routes:
+                LOG.debug("host_routes:%s", host_routes)
                 if gateway:
-                    LOG.debug("gateway:%s", gateway)
-                    options.append(self._format_option(subnet.ip_version,
-                                                       i, 'router',
-                                                       gateway))
-                else:
-                    options.append(self._format_option(subnet.ip_version,
-                                                       i, 'router'))
-        return options, subnet_index_map
+                    host_routes.append("%s,%s" % (constants.IPv4_ANY,
+                                                  gateway))
+                options.append(
+                    self._format_option(subnet.ip_version, i,
+                                        'classless-static-route',
+                                        ','.join(host_routes)))
+                options.append(
+                    self._format_option(subnet.ip_version, i,
+                                        WIN2k3_STATIC_DNS,
+                                        ','.join(host_routes)))
+
+            if gateway:
+                LOG.debug("gateway:%s", gateway)
+                options.append(self._format_option(subnet.ip_version,
+                                                   i, 'router',
+                                                   gateway))
+            else:
+                options.append(self._format_option(subnet.ip_version,
+                                                   i, 'router'))
+        return options
 
-    def _generate_opts_per_port(self, subnet_index_map):
-        options = []
-        dhcp_ips = collections.defaultdict(list)
-        LOG.debug("dhcp_ips:%s", dhcp_ips)
-        for port in self.network.ports:
-            if getattr(port, 'extra_dhcp_opts', False):
-                port_ip_versions = set(
-                    [netaddr.IPAddress(ip.ip_address).version
-                     for ip in port.fixed_ips])
-                for opt in port.extra_dhcp_opts:
-                    opt_ip_version = opt.ip_version
-                    if opt_ip_version in port_ip_versions:
-                        options.append(
-                            self._format_option(opt_ip_version, port.id,
-                                                opt.opt_name, opt.opt_value))
-                    else:
-                        LOG.info(("Cannot apply dhcp option %(opt)s "
-                                     "because it's ip_version %(version)d "
-                                     "is not in port's address IP versions"),
-                                 {'opt': opt.opt_name,
-                                  'version': opt_ip_version})
-
-            # provides all dnsmasq ip as dns-server if there is more than
-            # one dnsmasq for a subnet and there is no dns-server submitted
-            # by the server
-            if port.device_owner == constants.DEVICE_OWNER_DHCP:
-                for ip in port.fixed_ips:
-                    i = subnet_index_map.get(ip.subnet_id)
-                    if i is None:
-                        continue
-                    dhcp_ips[i].append(ip.ip_address)
+    def _generate_opts_for_port(self, port):
+        port_ip_versions = set(
+            [addr_cache.address(ip.ip_address).version
+             for ip in port.fixed_ips])
+        options, skipped = option_formatter.format_opts(
+            port.id, port.extra_dhcp_opts, port_ip_versions)
+        for opt in skipped:
+            LOG.info(("Cannot apply dhcp option %(opt)s "
+                         "because it's ip_version %(version)d "
+                         "is not in port's address IP versions"),
+                     {'opt': opt.opt_name,
+                      'version': opt.ip_version})
+        return options
+
+    def _generate_shared_opts_for_port(self, port):
+        """Return the tag and the options of a port with extra options.
 
+        With dnsmasq_share_option_tags, ports with the same options share
+        a tag derived from the options, whose lines are written once for
+        all of them; otherwise the tag is None and the options are
+        tagged with the port id.
+        """
+        if not self.conf.dnsmasq_share_option_tags:
+            return None, self._generate_opts_for_port(port)
+        # the lines without their leading 'tag:<port id>'
+        start = len('tag:') + len(port.id)
+        bodies = [option[start:]
+                  for option in self._generate_opts_for_port(port)]
+        tag = 'opts-%s' % _digest('\n'.join(sorted(bodies)))[:16]
+        return tag, ['tag:' + tag + body for body in bodies]
+
+    def _generate_dhcp_server_opts(self, dhcp_ips):
+        options = []
         for i, ips in dhcp_ips.items():
             for ip_version in (4, 6):
                 vx_ips = [ip for ip in ips
-                          if netaddr.IPAddress(ip).version == ip_version]
+                          if addr_cache.address(ip).version == ip_version]
                 if vx_ips:
                     options.append(
                         self._format_option(
@@ -791,48 +1720,26 @@ class Dnsmasq(DhcpLocalProcess):
                                                                   vx_ips))))
         return options
 
-    def _make_subnet_interface_ip_map(self):
-        ip_dev = ip_lib.IPDevice(self.interface_name,
-                                 namespace=self.network.namespace)
-
-        subnet_lookup = dict(
-            (netaddr.IPNetwork(subnet.cidr), subnet.id)
-            for subnet in self.network.subnets
-        )
+    def _make_subnet_interface_ip_map(self, dhcp_ports):
+        """Map each subnet to the address of the DHCP interface on it.
 
+        The interface holds the fixed IPs of the DHCP port of this agent,
+        so they are read from the port rather than from the device.
+        """
+        device_id = self.device_manager.get_device_id(self.network)
+        own_ports = [port for port in dhcp_ports
+                     if port.device_id == device_id]
         retval = {}
-
-        for addr in ip_dev.addr.list():
-            ip_net = netaddr.IPNetwork(addr['cidr'])
-
-            if ip_net in subnet_lookup:
-                retval[subnet_lookup[ip_net]] = addr['cidr'].split('/')[0]
-
+        for port in own_ports or dhcp_ports[:1]:
+            for fixed_ip in port.fixed_ips:
+                retval.setdefault(fixed_ip.subnet_id, fixed_ip.ip_address)
         return retval
 
     def _format_option(self, ip_version, tag, option, *args):
         """Format DHCP option by option name or code."""
-        LOG.debug("option :%s", str(option))
-        option = str(option)
-        pattern = "(tag:(.*),)?(.*)$"
-        matches = re.match(pattern, option)
-        extra_tag = matches.groups()[0]
-        option = matches.groups()[2]
-
         if isinstance(tag, int):
-            tag = self._TAG_PREFIX % tag
-
-        if not option.isdigit():
-            if ip_version == 4:
-                option = 'option:%s' % option
-            else:
-                option = 'option6:%s' % option
-        if extra_tag:
-            tags = ('tag:' + tag, extra_tag[:-1], '%s' % option)
-        else:
-            tags = ('tag:' + tag, '%s' % option)
-            LOG.debug("tags:%s", tags)
-        return ','.join(tags + args)
+            tag = self._subnet_tag(tag)
+        return option_formatter.format(ip_version, tag, option, *args)
 
     @staticmethod
     def _convert_to_literal_addrs(ip_version, ips):
@@ -848,6 +1755,10 @@ class Dnsmasq(DhcpLocalProcess):
         the subnet, and the port's ip address matches that of the subnet's
         gateway. The port must be owned by a nuetron router.
         """
+        isolated_subnets = isolation_map.get_isolated_subnets(network)
+        if isolated_subnets is not None:
+            return isolated_subnets
+
         isolated_subnets = collections.defaultdict(lambda: True)
         subnets = dict((subnet.id, subnet) for subnet in network.subnets)
 
@@ -876,8 +1787,8 @@ class Dnsmasq(DhcpLocalProcess):
         """
         if conf.enable_metadata_network and conf.enable_isolated_metadata:
             # check if the network has a metadata subnet
-            meta_cidr = netaddr.IPNetwork(METADATA_DEFAULT_CIDR)
-            if any(netaddr.IPNetwork(s.cidr) in meta_cidr
+            meta_cidr = addr_cache.network(METADATA_DEFAULT_CIDR)
+            if any(meta_cidr.contains(addr_cache.network(s.cidr))
                    for s in network.subnets):
                 return True
 
@@ -917,6 +1828,10 @@ class DeviceManager(object):
         # a device id that combines host and network ids
         return commonutils.get_dhcp_agent_device_id(network.id, self.conf.host)
 
+    def get_namespace(self, network):
+        """Return the namespace the DHCP device of network lives in."""
+        return network.namespace
+
     def _set_default_route(self, network, device_name):
         """Sets the default gateway for this dhcp namespace.
 
@@ -924,7 +1839,8 @@ class DeviceManager(object):
         it would change it from what it already is.  This makes it safe to call
         and avoids unnecessary perturbation of the system.
         """
-        device = ip_lib.IPDevice(device_name, namespace=network.namespace)
+        device = ip_lib.IPDevice(device_name,
+                                 namespace=self.get_namespace(network))
         gateway = device.route.get_gateway()
         LOG.debug("gateway:%s", gateway)
         if gateway:
@@ -1004,7 +1920,7 @@ class DeviceManager(object):
                       {'device_id': device_id, 'network_id': network.id})
             raise exceptions.DhcpPortNotFoundOnNetwork(net_id = network.id)
 
-        dhcp_port = DictModel(dhcp_port)
+        dhcp_port = DictModel(dhcp_port.to_dict())
         if not dhcp_port:
             raise exceptions.Conflict()
 
@@ -1024,10 +1940,11 @@ class DeviceManager(object):
         """Create and initialize a device for network's DHCP on this host."""
         port = self.setup_dhcp_port(network)
         interface_name = network['interfacename']
+        namespace = self.get_namespace(network)
         LOG.debug("DHCP_PORT :%s", port)
         LOG.debug("DPCP_PORT_NAME: %s", interface_name)
         if ip_lib.ensure_device_is_ready(interface_name,
-                                         namespace=network.namespace):
+                                         namespace=namespace):
             LOG.debug('Reusing existing device: %s.', interface_name)
         else:
             LOG.debug("Reusing not existing device:%s", interface_name)
@@ -1035,23 +1952,23 @@ class DeviceManager(object):
                              port.id,
                              interface_name,
                              None,
-                             namespace=network.namespace)
-            self.fill_dhcp_udp_checksums(namespace=network.namespace)
+                             namespace=namespace)
+            self.fill_dhcp_udp_checksums(namespace=namespace)
 
         ip_cidrs = []
         for fixed_ip in port.fixed_ips:
             LOG.debug("fixed_ip.subnet:%s", fixed_ip.subnet)
             subnet = fixed_ip.subnet
             if not ipv6_utils.is_auto_address_subnet(subnet):
-                net = netaddr.IPNetwork(subnet.cidr)
+                net = addr_cache.network(subnet.cidr)
                 ip_cidr = '%s/%s' % (fixed_ip.ip_address, net.prefixlen)
                 ip_cidrs.append(ip_cidr)
 
         self.driver.init_l3(interface_name, ip_cidrs,
-                            namespace=network.namespace)
+                            namespace=namespace)
 
         # ensure that the dhcp interface is first in the list
-        if network.namespace is None:
+        if namespace is None:
             device = ip_lib.IPDevice(interface_name)
             device.route.pullup_route(interface_name)
 
@@ -1068,8 +1985,9 @@ class DeviceManager(object):
     def destroy(self, network, device_name):
         """Destroy the device used for the network's DHCP on this host."""
         if device_name:
-            LOG.debug("device_name :%s namespace:%s", device_name, network.namespace)
-            self.driver.unplug(device_name, namespace=network.namespace)
+            namespace = self.get_namespace(network)
+            LOG.debug("device_name :%s namespace:%s", device_name, namespace)
+            self.driver.unplug(device_name, namespace=namespace)
         else:
             LOG.debug('No interface exists for network %s', network.id)
 
@@ -1086,3 +2004,432 @@ class DeviceManager(object):
     #    ovs = ovs_lib.BaseOVS()
     #    ovs.set_db_attribute('Port', interface_name, 'tag', tag)
 
+
+
+class SharedDeviceManager(DeviceManager):
+    """DeviceManager for DHCP interfaces sharing one namespace.
+
+    The namespace gets no default route: the subnets of every network are
+    on link, and the gateway of one network must not route the replies
+    sent to another.
+    """
+
+    def get_namespace(self, network):
+        if self.conf.use_namespaces:
+            return self.conf.dnsmasq_shared_namespace
+        return None
+
+    def _set_default_route(self, network, device_name):
+        pass
+
+
+class _SharedDnsmasqGroup(object):
+    """The dnsmasq serving every network of a shared namespace."""
+
+    def __init__(self, conf, name, namespace):
+        self.conf = conf
+        self.name = name
+        self.conf_dir = os.path.join(DhcpLocalProcess.get_confs_dir(conf),
+                                     name)
+        utils.ensure_dir(self.conf_dir)
+        # network id -> the SharedDnsmasq serving the network
+        self.members = {}
+        # command line of the running dnsmasq, None until known
+        self._cmdline = None
+        self.process_manager = external_process.ProcessManager(
+            conf=conf,
+            uuid=name,
+            namespace=namespace,
+            default_cmd_callback=self._spawn_cmdline,
+            pid_file=self.get_file_name('pid'),
+            run_as_root=True)
+
+    def lock(self):
+        return lockutils.lock('dnsmasq-group-%s' % self.name)
+
+    def get_file_name(self, kind):
+        return os.path.join(self.conf_dir, kind)
+
+    def build_cmdline(self, pid_file):
+        # the arguments of each member are those of its _member_args(),
+        # grouped by option
+        members = [self.members[network_id]
+                   for network_id in sorted(self.members)]
+        members = [member for member in members if member.interface_name]
+        cmd = [
+            'dnsmasq',
+            '--no-hosts',
+            '--no-resolv',
+            '--strict-order',
+            '--bind-interfaces',
+        ]
+        cmd += ['--interface=%s' % member.interface_name
+                for member in members]
+        cmd += [
+            '--except-interface=lo',
+            '--pid-file=%s' % pid_file,
+            '--dhcp-hostsdir=%s' % self.get_file_name('hostsdir'),
+            '--hostsdir=%s' % self.get_file_name('addn_hostsdir'),
+            '--dhcp-optsdir=%s' % self.get_file_name('optsdir'),
+        ]
+        cmd += ['--dhcp-optsfile=%s' % member.get_conf_file_name('opts')
+                for member in members]
+        cmd.append('--dhcp-leasefile=%s' % self.get_file_name('leases'))
+
+        possible_leases = 0
+        for member in members:
+            range_args, leases = member._build_dhcp_range_args()
+            cmd += range_args
+            cmd += member._build_mtu_args()
+            possible_leases += leases
+        cmd.append('--dhcp-lease-max=%d' %
+                   min(possible_leases, self.conf.dnsmasq_lease_max))
+
+        cmd += Dnsmasq._build_server_args(self.conf)
+        return cmd
+
+    def _spawn_cmdline(self, pid_file):
+        self._cmdline = self.build_cmdline(pid_file)
+        return self._cmdline
+
+    def running_cmdline(self):
+        if self._cmdline is None:
+            # dnsmasq outlived the previous agent
+            self._cmdline = self.process_manager.cmdline
+        return self._cmdline
+
+    def update(self, process_monitor, restart=False):
+        """Start, restart or stop dnsmasq to serve the current members.
+
+        A running dnsmasq is only restarted when restart is True, and
+        stopped once the group has no members left.
+
+        Returns True if dnsmasq was (re)started.
+        """
+        pm = self.process_manager
+        if not self.members:
+            process_monitor.unregister(self.name, DNSMASQ_SERVICE_NAME)
+            pm.disable()
+            self._cmdline = None
+            return False
+        if pm.active:
+            if not restart:
+                return False
+            LOG.debug('Restarting the dnsmasq of group %s', self.name)
+            pm.disable()
+        pm.enable()
+        process_monitor.register(uuid=self.name,
+                                 service_name=DNSMASQ_SERVICE_NAME,
+                                 monitored_process=pm)
+        return True
+
+
+class SharedDnsmasq(Dnsmasq):
+    """Serve the networks of a namespace group from a single dnsmasq.
+
+    The DHCP interfaces of all networks are plugged into the namespace
+    named by dnsmasq_shared_namespace and one dnsmasq listens on all of
+    them, instead of one dnsmasq and one namespace per network.  dnsmasq
+    picks the DHCP range of a request, and so its tags, by the address of
+    the interface it came in on, which is why the subnets of the networks
+    in a group must not overlap.  Subnet tags carry the network id, port
+    files are prefixed with it and every network keeps its own opts file,
+    so the options of different networks never mix.
+
+    Port changes go through the shared hostsdir and optsdir as with
+    Dnsmasq in hostsdir mode.  dnsmasq reads interfaces and DHCP ranges
+    from its command line only, so the shared dnsmasq is restarted when a
+    network needs arguments it does not run with yet: a new network, or
+    new subnets.  A network leaving the group only empties its files and
+    signals dnsmasq to reload; its arguments linger until the next restart
+    and are reused if it comes back.
+
+    A network still served by a dnsmasq of its own, left behind by the
+    Dnsmasq driver, is moved into the group the first time it is enabled
+    or reloaded.
+    """
+
+    shares_lease_file = True
+
+    # files of the whole group, kept in the group's directory
+    GROUP_FILES = ('hostsdir', 'addn_hostsdir', 'optsdir', 'leases', 'pid')
+
+    def __init__(self, conf, network, process_monitor, version=None,
+                 plugin=None):
+        super(SharedDnsmasq, self).__init__(conf, network, process_monitor,
+                                            version, plugin)
+        self.group = self._get_group(conf)
+
+    @staticmethod
+    def _get_group(conf):
+        name = conf.dnsmasq_shared_namespace
+        group = shared_groups.get(name)
+        if group is None:
+            group = shared_groups[name] = _SharedDnsmasqGroup(
+                conf, name, name if conf.use_namespaces else None)
+        return group
+
+    def _get_device_manager(self, plugin):
+        return SharedDeviceManager(self.conf, plugin)
+
+    @classmethod
+    def check_version(cls):
+        version = super(SharedDnsmasq, cls).check_version()
+        if not version or version < cls.MINIMUM_HOSTSDIR_VERSION:
+            LOG.error('The shared dnsmasq driver needs dnsmasq %d.%d or '
+                      'newer', *cls.MINIMUM_HOSTSDIR_VERSION)
+            raise SystemExit(1)
+        return version
+
+    @property
+    def use_hostsdir(self):
+        return True
+
+    @classmethod
+    def get_lease_file_name(cls, conf, network_id):
+        return os.path.join(cls.get_confs_dir(conf),
+                            conf.dnsmasq_shared_namespace, 'leases')
+
+    def get_conf_file_name(self, kind):
+        if kind in self.GROUP_FILES:
+            return self.group.get_file_name(kind)
+        return super(SharedDnsmasq, self).get_conf_file_name(kind)
+
+    @property
+    def _port_file_prefix(self):
+        return '%s.' % self.network.id
+
+    def _subnet_tag(self, index):
+        return 'tag%d-%s' % (index, self.network.id)
+
+    def _member_args(self):
+        """Return the arguments the network adds to the group's."""
+        args = ['--interface=%s' % self.interface_name,
+                '--dhcp-optsfile=%s' % self.get_conf_file_name('opts')]
+        args += self._build_dhcp_range_args()[0]
+        args += self._build_mtu_args()
+        return args
+
+    def _cmdline_changed(self):
+        """Whether dnsmasq lacks arguments the network needs.
+
+        Arguments the network no longer needs, like the range of a deleted
+        subnet, are left to linger as those of a network leaving the group
+        are; any new range or interface restarts dnsmasq and drops them.
+        The arguments of the other members and the lease cap, which grows
+        with every network, are left alone.
+        """
+        running = self.group.running_cmdline()
+        if running is None:
+            return True
+        return not set(self._member_args()).issubset(running)
+
+    def _build_mtu_args(self):
+        # the networks of a group may have different MTUs
+        if not super(SharedDnsmasq, self)._build_mtu_args():
+            return []
+        return ['--dhcp-option-force=tag:%s,option:mtu,%d' %
+                (self._subnet_tag(i), self.network.mtu)
+                for i, subnet in enumerate(self.network.subnets)
+                if subnet.enable_dhcp and subnet.ip_version == 4]
+
+    def _get_process_manager(self, cmd_callback=None):
+        return self.group.process_manager
+
+    @property
+    def active(self):
+        return (self.network.id in self.group.members and
+                self.group.process_manager.active)
+
+    def enable(self):
+        """Add the network to its group and serve it."""
+        if not self._enable_dhcp():
+            return
+        with self.group.lock():
+            self._join_group()
+            files, allocations = self._render_config_files()
+            self._output_init_lease_file(files)
+            changed = self._output_config_files(files)
+            restart = (self.group.process_manager.active and
+                       self._cmdline_changed())
+            if (not self.group.update(self.process_monitor, restart) and
+                    changed):
+                self.group.process_manager.reload_cfg()
+                self.reload_stats['performed'] += 1
+
+    def restart(self):
+        """Rewrite the files of the network and apply them.
+
+        The shared dnsmasq is only restarted when it runs with other
+        arguments for the network, otherwise it is signalled to reload so
+        the other networks of the group are not disturbed.
+        """
+        self.enable()
+
+    def _join_group(self):
+        """Plug the network into the shared namespace and serve it."""
+        self._check_overlap()
+        if self.network.id not in self.group.members:
+            self._migrate_from_own_dnsmasq()
+        utils.ensure_dir(self.network_conf_dir)
+        self.interface_name = self.device_manager.setup(self.network)
+        self.group.members[self.network.id] = self
+
+    def _check_overlap(self):
+        cidrs = [addr_cache.network(subnet.cidr)
+                 for subnet in self.network.subnets]
+        for network_id, member in six.iteritems(self.group.members):
+            if network_id == self.network.id:
+                continue
+            for subnet in member.network.subnets:
+                other = addr_cache.network(subnet.cidr)
+                for cidr in cidrs:
+                    if cidr.overlaps(other):
+                        raise exceptions.SubnetOverlap(
+                            cidr=cidr.cidr, net_id=self.network.id,
+                            other_cidr=subnet.cidr, other_net_id=network_id)
+
+    def _migrate_from_own_dnsmasq(self):
+        """Stop the dnsmasq the Dnsmasq driver ran for the network.
+
+        Its interface is unplugged from the network's own namespace, which
+        is deleted if dhcp_delete_namespaces is set, and the files only
+        that dnsmasq used are removed.
+        """
+        pid_file = os.path.join(self.network_conf_dir, 'pid')
+        if not os.path.exists(pid_file):
+            return
+        LOG.info('Moving network %(net)s to the dnsmasq of group %(group)s',
+                 {'net': self.network.id, 'group': self.group.name})
+        namespace = None
+        if self.conf.use_namespaces:
+            namespace = '%s%s' % (NS_PREFIX, self.network.id)
+        self.process_monitor.unregister(self.network.id,
+                                        DNSMASQ_SERVICE_NAME)
+        external_process.ProcessManager(
+            conf=self.conf,
+            uuid=self.network.id,
+            namespace=namespace,
+            pid_file=pid_file,
+            run_as_root=True).disable()
+        if self.interface_name:
+            try:
+                self.device_manager.driver.unplug(self.interface_name,
+                                                  namespace=namespace)
+            except RuntimeError:
+                LOG.warning('Failed trying to unplug interface %s',
+                            self.interface_name)
+        if self.conf.dhcp_delete_namespaces and namespace:
+            try:
+                ip_lib.IPWrapper(namespace=namespace).netns.delete(namespace)
+            except RuntimeError:
+                LOG.warning('Failed trying to delete namespace: %s',
+                            namespace)
+        config_digests.pop(self.network.id, None)
+        port_file_state.pop(self.network.id, None)
+        self.option_set_stats = None
+        for kind in self.GROUP_FILES + ('host', 'addn_hosts'):
+            path = os.path.join(self.network_conf_dir, kind)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def disable(self, retain_port=False):
+        """Stop serving the network.
+
+        dnsmasq keeps running for the other networks of the group and is
+        only signalled to reload: the arguments of the network stay on its
+        command line until the next restart, but its interface is gone and
+        its hosts and opts files are empty, so they serve nothing.
+        """
+        with self.group.lock():
+            member = self.group.members.pop(self.network.id, None)
+            if not retain_port:
+                try:
+                    self.device_manager.destroy(self.network,
+                                                self.interface_name)
+                except RuntimeError:
+                    LOG.warning('Failed trying to delete interface: %s',
+                                self.interface_name)
+            self._remove_config_files()
+            pm = self.group.process_manager
+            if member is not None and self.group.members and pm.active:
+                # dnsmasq rereads the opts file of every member on SIGHUP
+                utils.ensure_dir(self.network_conf_dir)
+                utils.replace_file(self.get_conf_file_name('opts'), '')
+                pm.reload_cfg()
+                self.reload_stats['performed'] += 1
+            else:
+                self.group.update(self.process_monitor)
+            namespace = self.namespace
+            if (not retain_port and not self.group.members and
+                    self.conf.dhcp_delete_namespaces and namespace):
+                try:
+                    ip_lib.IPWrapper(namespace=namespace).netns.delete(
+                        namespace)
+                except RuntimeError:
+                    LOG.warning('Failed trying to delete namespace: %s',
+                                namespace)
+
+    def _remove_config_files(self):
+        prefix = self._port_file_prefix
+        for kind, dir_kind in self.PORT_DIRS:
+            port_dir = self.get_conf_file_name(dir_kind)
+            try:
+                names = os.listdir(port_dir)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(port_dir, name))
+                    except OSError:
+                        pass
+        super(SharedDnsmasq, self)._remove_config_files()
+
+    def reload_allocations(self):
+        if self._enable_dhcp() and not self.active:
+            # after an agent restart, when moving the network over from a
+            # dnsmasq of its own, or when the shared dnsmasq died
+            self.enable()
+            return
+        super(SharedDnsmasq, self).reload_allocations()
+
+    def _spawn_or_reload_process(self, reload_with_HUP, files=None):
+        with self.group.lock():
+            return super(SharedDnsmasq, self)._spawn_or_reload_process(
+                reload_with_HUP, files)
+
+    def _output_init_lease_file(self, files=None):
+        """Replace the leases of the network in the group's lease file.
+
+        The leases of the other networks of the group are kept; leases
+        belong to the network whose subnets hold their address.
+        """
+        if files is None:
+            files, allocations = self._render_config_files()
+        filename = self.get_conf_file_name('leases')
+        subnets = [addr_cache.network(subnet.cidr)
+                   for subnet in self.network.subnets]
+        kept = []
+        try:
+            with open(filename) as f:
+                for line in f:
+                    fields = line.split()
+                    try:
+                        ours = False
+                        if len(fields) > 2 and fields[0] != 'duid':
+                            address = addr_cache.address(
+                                fields[2].strip('[]'))
+                            ours = any(subnet.contains(address)
+                                       for subnet in subnets)
+                    except (netaddr.AddrFormatError, ValueError):
+                        ours = False
+                    if not ours:
+                        kept.append(line)
+        except IOError:
+            pass
+        utils.replace_file(filename, ''.join(kept) + files['leases'])
+        LOG.debug('Done building initial lease file %s', filename)
+        return filename
@@ -25,11 +25,20 @@ class MonitoredProcess(object):
     def enable(self):
         """Enable the service, or respawn the process."""
 
+    def invalidate(self):
+        """Forget cached state, the next check looks at the process."""
+
 
 class ProcessManager(MonitoredProcess):
     """An external process manager for Neutron spawned processes.
 
     Note: The manager expects uuid to be in cmdline.
+
+    The pid and the start time of the process, once it was verified to be
+    ours through /proc, are kept in memory.  A liveness check re-reads the
+    start time from /proc/<pid>/stat and only goes back to the pid file
+    and the command line when it no longer matches, i.e. the process
+    exited or its pid was reused.
     """
     def __init__(self, conf, uuid, namespace=None, service=None,
                  pids_path=None, default_cmd_callback=None,
@@ -43,6 +52,9 @@ class ProcessManager(MonitoredProcess):
         self.pids_path = pids_path or self.conf.external_pids
         self.pid_file = pid_file
         self.run_as_root = run_as_root
+        self._pid = None
+        # start time of _pid once it was verified to be ours
+        self._start_time = None
 
         if service:
             self.service_pid_fname = 'pid.' + service
@@ -60,8 +72,12 @@ class ProcessManager(MonitoredProcess):
             cmd = cmd_callback(self.get_pid_file_name())
 
             ip_wrapper = ip_lib.IPWrapper(namespace=self.namespace)
-            ip_wrapper.netns.execute(cmd, addl_env=self.cmd_addl_env,
-                                     run_as_root=self.run_as_root)
+            try:
+                ip_wrapper.netns.execute(cmd, addl_env=self.cmd_addl_env,
+                                         run_as_root=self.run_as_root)
+            finally:
+                # the new process wrote its own pid file
+                self.invalidate()
         elif reload_cfg:
             self.reload_cfg()
 
@@ -73,10 +89,15 @@ class ProcessManager(MonitoredProcess):
 
         if self.active:
             cmd = ['kill', '-%s' % (sig), pid]
-            utils.execute(cmd, run_as_root=True)
+            try:
+                utils.execute(cmd, run_as_root=True)
+            except RuntimeError:
+                self.invalidate()
+                raise
             # In the case of shutting down, remove the pid file
             if sig == '9':
                 fileutils.delete_if_exists(self.get_pid_file_name())
+                self.invalidate()
         elif pid:
             LOG.debug('Process for %(uuid)s pid %(pid)d is stale, ignoring '
                       'signal %(signal)s', {'uuid': self.uuid, 'pid': pid,
@@ -93,10 +114,19 @@ class ProcessManager(MonitoredProcess):
                                             self.uuid,
                                             self.service_pid_fname)
 
+    def invalidate(self):
+        self._pid = None
+        self._start_time = None
+
     @property
     def pid(self):
         """Last known pid for this external process spawned for this uuid."""
-        return utils.get_value_from_file(self.get_pid_file_name(), int)
+        # a missing pid file is not cached, the process may be starting
+        if self._pid is None:
+            self._pid = utils.get_value_from_file(self.get_pid_file_name(),
+                                                  int)
+            self._start_time = None
+        return self._pid
 
     @property
     def active(self):
@@ -104,13 +134,52 @@ class ProcessManager(MonitoredProcess):
         if pid is None:
             return False
 
-        cmdline = '/proc/%s/cmdline' % pid
+        start_time = self._read_start_time(pid)
+        if start_time is not None and start_time == self._start_time:
+            return True
+        if self._start_time is not None:
+            # the pid exited or was reused since it was verified, the pid
+            # file may name a process started in the meantime
+            self.invalidate()
+            pid = self.pid
+            if pid is None:
+                return False
+            start_time = self._read_start_time(pid)
+        if start_time is None or not self._is_our_process(pid):
+            # re-read the pid file on the next check
+            self.invalidate()
+            return False
+        self._start_time = start_time
+        return True
+
+    @property
+    def cmdline(self):
+        """The arguments the running process was started with, or None."""
+        if not self.active:
+            return None
         try:
-            with open(cmdline, "r") as f:
+            with open('/proc/%s/cmdline' % self.pid, "r") as f:
+                return f.read().rstrip('\0').split('\0')
+        except IOError:
+            return None
+
+    def _is_our_process(self, pid):
+        """Whether the command line of pid names our uuid."""
+        try:
+            with open('/proc/%s/cmdline' % pid, "r") as f:
                 return self.uuid in f.readline()
         except IOError:
             return False
 
+    def _read_start_time(self, pid):
+        """Return the start time of pid, or None if it is gone."""
+        try:
+            with open('/proc/%s/stat' % pid, "r") as f:
+                # starttime is the 22nd field, the 2nd one (comm) may
+                # contain spaces but ends with the last ')'
+                return f.read().rsplit(')', 1)[1].split()[19]
+        except (IOError, IndexError):
+            return None
 
 ServiceId = collections.namedtuple('ServiceId', ['uuid', 'service'])
 
@@ -192,6 +261,8 @@ class ProcessMonitor(object):
         # dictionary which otherwise will cause a RuntimeError
         for service_id in list(self._monitored_processes):
             pm = self._monitored_processes.get(service_id)
+            if pm:
+                pm.invalidate()
 
             if pm and not pm.active:
                 LOG.error(("%(service)s for %(resource_type)s "
@@ -7,6 +7,7 @@ from oslo_config import cfg
 import six
 from common import ovs_lib
 from nspagent.dhcp.linux import ip_lib
+from common import addr_cache
 from common import constants as n_const
 from common import exceptions
 
@@ -40,11 +41,11 @@ class LinuxInterfaceDriver(object):
         # add new addresses
         for ip_cidr in ip_cidrs:
 
-            net = netaddr.IPNetwork(ip_cidr)
+            net = addr_cache.network(ip_cidr)
             # Convert to compact IPv6 address because the return values of
             # "ip addr list" are compact.
             if net.version == 6:
-                ip_cidr = str(net)
+                ip_cidr = net.cidr
             if ip_cidr in previous:
                 previous.remove(ip_cidr)
                 continue
@@ -489,7 +489,7 @@ class IpNetnsCommand(IpCommandBase):
 
     def execute(self, cmds, addl_env=None, check_exit_code=True,
                 log_fail_as_error=True, extra_ok_codes=None,
-                run_as_root=False):
+                run_as_root=False, process_input=None):
         ns_params = []
         kwargs = {'run_as_root': run_as_root}
         if self._parent.namespace:
@@ -501,7 +501,8 @@ class IpNetnsCommand(IpCommandBase):
             env_params = (['env'] +
                           ['%s=%s' % pair for pair in addl_env.items()])
         cmd = ns_params + env_params + list(cmds)
-        return utils.execute(cmd, check_exit_code=check_exit_code,
+        return utils.execute(cmd, process_input=process_input,
+                             check_exit_code=check_exit_code,
                              extra_ok_codes=extra_ok_codes,
                              log_fail_as_error=log_fail_as_error, **kwargs)
 
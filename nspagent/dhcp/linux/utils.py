@@ -133,17 +133,20 @@ def execute(cmd, process_input=None, addl_env=None,
     return (_stdout, _stderr) if return_stderr else _stdout
 
 
-def replace_file(file_name, data, file_mode=0o644):
+def replace_file(file_name, data, file_mode=0o644, tmp_prefix='tmp'):
     """Replaces the contents of file_name with data in a safe manner.
 
     First write to a temp file and then rename. Since POSIX renames are
     atomic, the file is unlikely to be corrupted by competing writes.
 
     We create the tempfile on the same device to ensure that it can be renamed.
+    tmp_prefix names the tempfile, e.g. a dot keeps it hidden from processes
+    watching the directory.
     """
 
     base_dir = os.path.dirname(os.path.abspath(file_name))
-    tmp_file = tempfile.NamedTemporaryFile('w+', dir=base_dir, delete=False)
+    tmp_file = tempfile.NamedTemporaryFile('w+', dir=base_dir, delete=False,
+                                           prefix=tmp_prefix)
     tmp_file.write(data)
     tmp_file.close()
     os.chmod(tmp_file.name, file_mode)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import collections
+import time
+
+import gevent
+from gevent import event
+from common import uuidutils
+from logger import log as LOG
+
+JOB_QUEUED = 'QUEUED'
+JOB_RUNNING = 'RUNNING'
+JOB_SUCCESS = 'SUCCESS'
+JOB_FAILED = 'FAILED'
+
+
+class Job(object):
+    """A unit of work queued behind the other work of a network."""
+
+    def __init__(self, network_id, action, func, args, kwargs):
+        self.id = uuidutils.generate_uuid()
+        self.network_id = network_id
+        self.action = action
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = JOB_QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.pool = None
+        self.result = event.AsyncResult()
+
+    def run(self, pool):
+        """Run the job on pool.
+
+        A job may return an AsyncResult to hand the rest of its work off,
+        e.g. to a coalesced reload.  The worker moves on to the next job
+        right away and this job completes once that result is ready.
+        """
+        self.status = JOB_RUNNING
+        self.started_at = time.time()
+        try:
+            # the pool caps how many networks do driver work at once
+            value = pool.apply(self.func, self.args, self.kwargs)
+        except Exception as e:
+            self._finish(error=e)
+        else:
+            if isinstance(value, event.AsyncResult):
+                value.rawlink(self._finish_deferred)
+            else:
+                self._finish(value=value)
+        finally:
+            # drop the payload, only the bookkeeping is kept around
+            self.func = self.args = self.kwargs = self.pool = None
+
+    def _finish_deferred(self, deferred):
+        if deferred.successful():
+            self._finish(value=deferred.value)
+        else:
+            self._finish(error=deferred.exception)
+
+    def _finish(self, value=None, error=None):
+        self.finished_at = time.time()
+        if error is not None:
+            LOG.debug("Job %(job)s (%(action)s) for network %(net)s "
+                      "failed: %(err)s",
+                      {'job': self.id, 'action': self.action,
+                       'net': self.network_id, 'err': error})
+            self.status = JOB_FAILED
+            self.error = str(error)
+            self.result.set_exception(error)
+        else:
+            LOG.debug("Job %(job)s (%(action)s) for network %(net)s done "
+                      "in %(time).3fs",
+                      {'job': self.id, 'action': self.action,
+                       'net': self.network_id,
+                       'time': self.finished_at - self.created_at})
+            self.status = JOB_SUCCESS
+            self.result.set(value)
+
+    def get(self, timeout=None):
+        """Wait for the job and return its result, or raise its error."""
+        return self.result.get(timeout=timeout)
+
+    def to_dict(self):
+        queued = (self.started_at or time.time()) - self.created_at
+        running = None
+        if self.started_at:
+            running = (self.finished_at or time.time()) - self.started_at
+        return {'id': self.id,
+                'network_id': self.network_id,
+                'action': self.action,
+                'status': self.status,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'queued_time': queued,
+                'run_time': running,
+                'latency': (self.finished_at - self.created_at
+                            if self.finished_at else None)}
+
+
+class NetworkWorkQueue(object):
+    """Serialize work per network while running networks in parallel.
+
+    Every network gets its own FIFO of jobs, drained by a dedicated worker
+    greenlet which exits as soon as the FIFO is empty.  Jobs for the same
+    network run strictly in submission order; jobs for different networks
+    run concurrently, bounded by the size of the given pool.
+
+    The most recent max_jobs jobs are remembered so their status can be
+    looked up after they completed.
+    """
+
+    def __init__(self, pool, max_jobs=1000):
+        self._pool = pool
+        self._queues = {}
+        self._jobs = collections.OrderedDict()
+        self._max_jobs = max_jobs
+        # the last unfinished job announcing each key, see announce()
+        self._announced = {}
+
+    def submit(self, network_id, action, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) behind the work of network_id.
+
+        Returns the Job tracking the call.
+        """
+        return self.enqueue(Job(network_id, action, func, args, kwargs))
+
+    def enqueue(self, job, pool=None):
+        """Queue a job, optionally running it on pool instead of ours.
+
+        A separate pool lets a batch of jobs have its own concurrency cap
+        while still being ordered with the other work of each network.
+        """
+        job.pool = pool
+        self._remember(job)
+        queue = self._queues.get(job.network_id)
+        if queue is None:
+            queue = self._queues[job.network_id] = collections.deque([job])
+            gevent.spawn(self._worker, job.network_id, queue)
+        else:
+            queue.append(job)
+        return job
+
+    def get_job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def pending(self, network_id=None):
+        """Return the number of queued jobs, for one or all networks."""
+        if network_id is not None:
+            return len(self._queues.get(network_id, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def announce(self, job, keys):
+        """Record that job may add keys, e.g. port ids, to the cache.
+
+        Until the job has finished, network_of() finds its network by any
+        of these keys, so work on what the job is about to add can be
+        queued behind it before the cache knows about it.
+        """
+        keys = list(keys)
+        for key in keys:
+            self._announced[key] = job
+        job.result.rawlink(lambda result: self._forget(job, keys))
+
+    def network_of(self, key):
+        """Return the network of the last unfinished job announcing key."""
+        job = self._announced.get(key)
+        return job.network_id if job is not None else None
+
+    def _forget(self, job, keys):
+        for key in keys:
+            if self._announced.get(key) is job:
+                del self._announced[key]
+
+    def _remember(self, job):
+        self._jobs[job.id] = job
+        while len(self._jobs) > self._max_jobs:
+            self._jobs.popitem(last=False)
+
+    def _worker(self, network_id, queue):
+        try:
+            while queue:
+                job = queue.popleft()
+                job.run(job.pool or self._pool)
+        finally:
+            # no greenlet switch can happen between the empty check above
+            # and this removal, so no job is ever left behind
+            del self._queues[network_id]
+
+
+class ReloadCoalescer(object):
+    """Merge bursts of reload requests for a network into one driver call.
+
+    The first request for a network opens a window of `window` seconds.
+    Every further request pushes the end of the window out again, but never
+    past `max_delay` seconds after the first request.  When the window
+    closes, flush(network_id, action) is queued on the network's work queue
+    with the strongest action requested during the window.
+    """
+
+    # actions in increasing order of cost; a restart covers a reload
+    ACTIONS = ('reload_allocations', 'restart')
+
+    def __init__(self, queues, flush, window, max_delay):
+        self._queues = queues
+        self._flush = flush
+        self._window = window
+        self._max_delay = max(max_delay, window)
+        self._pending = {}
+
+    def request(self, network_id, action):
+        """Ask for action to be run on network_id.
+
+        Returns an AsyncResult which is set once the coalesced driver call
+        has finished, or holds its exception.
+        """
+        now = time.time()
+        pending = self._pending.get(network_id)
+        if pending is None:
+            pending = self._pending[network_id] = _PendingReload(action, now)
+            gevent.spawn(self._wait_and_flush, network_id, pending)
+        elif self.ACTIONS.index(action) > self.ACTIONS.index(pending.action):
+            pending.action = action
+        pending.requests += 1
+        pending.deadline = min(now + self._window,
+                               pending.first_request + self._max_delay)
+        return pending.result
+
+    def _wait_and_flush(self, network_id, pending):
+        delay = pending.deadline - time.time()
+        while delay > 0:
+            gevent.sleep(delay)
+            delay = pending.deadline - time.time()
+        # requests arriving from now on open a new window, they need a
+        # reload that sees their changes
+        del self._pending[network_id]
+        LOG.debug("Coalesced %(count)d reload requests for network "
+                  "%(net)s into one %(action)s",
+                  {'count': pending.requests, 'net': network_id,
+                   'action': pending.action})
+        job = self._queues.submit(network_id, pending.action, self._flush,
+                                  network_id, pending.action)
+        try:
+            job.get()
+        except Exception as e:
+            pending.result.set_exception(e)
+        else:
+            pending.result.set(None)
+
+
+class _PendingReload(object):
+
+    def __init__(self, action, first_request):
+        self.action = action
+        self.first_request = first_request
+        self.deadline = first_request
+        self.requests = 0
+        self.result = event.AsyncResult()
@@ -255,6 +255,13 @@ class API(Router):
                         'method':'POST'
                     },
 
+                    {
+                        'name':'network_bulk_create_end',
+                        'url':'/dhcp_network/bulk',
+                        'action':'network_bulk_create_end',
+                        'method':'POST'
+                    },
+
                     {
                         'name':'network_update_end',
                         'url':'/dhcp_network/',
@@ -304,6 +311,13 @@ class API(Router):
                         'method':'PUT'
                     },
 
+                    {
+                        'name':'port_bulk_end',
+                        'url':'/dhcp_port/bulk',
+                        'action':'port_bulk_end',
+                        'method':'POST'
+                    },
+
                     {
                         'name':'port_delete_end',
                         'url':'/dhcp_port/:port_id',
@@ -311,6 +325,48 @@ class API(Router):
                         'method':'DELETE'
                     },
 
+                    {
+                        'name':'sync_state',
+                        'url':'/dhcp_sync',
+                        'action':'sync_state',
+                        'method':'PUT'
+                    },
+
+                    {
+                        'name':'get_ports_by_mac',
+                        'url':'/dhcp_port/mac/:mac_address',
+                        'action':'get_ports_by_mac',
+                        'method':'GET'
+                    },
+
+                    {
+                        'name':'get_ports_by_ip',
+                        'url':'/dhcp_port/ip/:ip_address',
+                        'action':'get_ports_by_ip',
+                        'method':'GET'
+                    },
+
+                    {
+                        'name':'get_state',
+                        'url':'/dhcp_state',
+                        'action':'get_state',
+                        'method':'GET'
+                    },
+
+                    {
+                        'name':'get_lease_stats',
+                        'url':'/dhcp_leases',
+                        'action':'get_lease_stats',
+                        'method':'GET'
+                    },
+
+                    {
+                        'name':'get_job',
+                        'url':'/jobs/:job_id',
+                        'action':'get_job',
+                        'method':'GET'
+                    },
+
                 ]
 
                 )
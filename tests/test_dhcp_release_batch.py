@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Tests of dhcp_release_batch against a local UDP listener.
+
+Run from the top of the tree with: python -m unittest discover -s tests
+"""
+
+import imp
+import os
+import socket
+import StringIO
+import struct
+import sys
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dhcp_release_batch')
+
+MAC = 'fa:16:3e:12:34:56'
+LOOPBACK = 'lo'
+
+
+def load_script():
+    """Load a fresh copy, so what a test patches does not leak.
+
+    The script has no .py suffix, so the bytecode imp would write next to
+    it is not ignored by git; none is written.
+    """
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source('dhcp_release_batch', SCRIPT)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+
+class NativeReleaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = load_script()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(2)
+        # the listener stands in for dnsmasq, reached through loopback
+        self.batch.DHCP_SERVER_PORT = self.listener.getsockname()[1]
+        self.batch.get_interface_addresses = lambda interface: [
+            ('127.0.0.1', 8)]
+        try:
+            self.releaser = self.batch.NativeReleaser(LOOPBACK)
+        except socket.error as e:
+            self.skipTest('cannot bind to %s: %s' % (LOOPBACK, e))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_release_wire_format(self):
+        self.assertTrue(self.releaser.release('127.0.0.5', MAC))
+        packet, source = self.listener.recvfrom(1024)
+
+        self.assertEqual(250, len(packet))
+        op, htype, hlen = struct.unpack('!BBB', packet[:3])
+        self.assertEqual((1, 1, 6), (op, htype, hlen))
+        self.assertEqual(socket.inet_aton('127.0.0.5'), packet[12:16])
+        self.assertEqual(b'\0' * 12, packet[16:28])
+        self.assertEqual(MAC.replace(':', '').decode('hex'), packet[28:34])
+        self.assertEqual(b'\0' * 10, packet[34:44])
+        self.assertEqual(0x63825363,
+                         struct.unpack('!I', packet[236:240])[0])
+        # DHCP message type 53 = DHCPRELEASE (7)
+        self.assertEqual((53, 1, 7), struct.unpack('!BBB', packet[240:243]))
+        # server identifier 54 = the address of the DHCP interface
+        self.assertEqual((54, 4), struct.unpack('!BB', packet[243:245]))
+        self.assertEqual(socket.inet_aton('127.0.0.1'), packet[245:249])
+        self.assertEqual(255, ord(packet[249]))
+
+    def test_release_needs_fallback(self):
+        # IPv6, and IPv4 on no subnet of the interface
+        self.assertFalse(self.releaser.release('fd00::5', MAC))
+        self.assertFalse(self.releaser.release('10.1.2.3', MAC))
+
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = load_script()
+        self.batch.get_interface_addresses = lambda interface: [
+            ('127.0.0.1', 8)]
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.batch.DHCP_SERVER_PORT = self.listener.getsockname()[1]
+        self.fallback = []
+        self.failing = set()
+        self.batch.dhcp_release = self._dhcp_release
+        self.stdout = StringIO.StringIO()
+        self.stderr = StringIO.StringIO()
+        self.batch.sys.stdout = self.stdout
+        self.batch.sys.stderr = self.stderr
+
+    def tearDown(self):
+        self.listener.close()
+        self.batch.sys.stdin = self.batch.sys.__stdin__
+        self.batch.sys.stdout = self.batch.sys.__stdout__
+        self.batch.sys.stderr = self.batch.sys.__stderr__
+
+    def _dhcp_release(self, interface, ip_address, mac_address):
+        self.fallback.append((interface, ip_address, mac_address))
+        return ip_address not in self.failing
+
+    def _main(self, lines, *args):
+        self.batch.sys.stdin = StringIO.StringIO(''.join(lines))
+        return self.batch.main(['dhcp_release_batch'] + list(args) +
+                               [LOOPBACK])
+
+    def test_fallback_to_dhcp_release(self):
+        try:
+            self.batch.NativeReleaser(LOOPBACK)
+        except socket.error as e:
+            self.skipTest('cannot bind to %s: %s' % (LOOPBACK, e))
+        code = self._main(['127.0.0.5 %s\n' % MAC,
+                           'fd00::5 %s\n' % MAC,
+                           '10.1.2.3 %s\n' % MAC])
+        self.assertEqual(0, code)
+        self.assertEqual([(LOOPBACK, 'fd00::5', MAC),
+                          (LOOPBACK, '10.1.2.3', MAC)], self.fallback)
+        self.assertTrue(self.stdout.getvalue().startswith(
+            'released 3 failed 0'))
+
+    def test_native_unavailable(self):
+        def unavailable(interface):
+            raise socket.error('no such device')
+        self.batch.NativeReleaser = unavailable
+        code = self._main(['127.0.0.5 %s\n' % MAC])
+        self.assertEqual(0, code)
+        self.assertEqual([(LOOPBACK, '127.0.0.5', MAC)], self.fallback)
+        self.assertIn('Native release unavailable', self.stderr.getvalue())
+
+    def test_partial_failure(self):
+        self.failing.add('10.0.0.6')
+        code = self._main(['10.0.0.5 %s\n' % MAC,
+                           '10.0.0.6 %s\n' % MAC,
+                           'malformed\n'],
+                          '--backend=dhcp_release')
+        self.assertEqual(self.batch.PARTIAL_FAILURE, code)
+        self.assertEqual(3, code)
+        self.assertEqual(['10.0.0.5', '10.0.0.6'],
+                         [ip for _, ip, _ in self.fallback])
+        self.assertTrue(self.stdout.getvalue().startswith(
+            'released 1 failed 2'))
+
+    def test_usage(self):
+        self.assertEqual(2, self._main([], '--backend=bogus'))
+
+
+if __name__ == '__main__':
+    unittest.main()
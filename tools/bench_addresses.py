@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Time the address parsing of a reload with and without the shared cache.
+
+    python tools/bench_addresses.py [PORTS]
+
+A dual-stack network of PORTS ports (default 2000) is rendered as on a
+reload after an agent restart, with the per-port caches empty, and its
+fixed IPs are formatted and parsed.
+'uncached' parses every address and CIDR again, as before
+common.addr_cache, 'cached' goes through the shared cache as the agent
+does.  Times are the best CPU time of a few runs.
+"""
+
+import shutil
+import sys
+
+import netaddr
+
+import synthetic
+
+from common import addr_cache
+from nspagent.dhcp.linux import dhcp
+
+
+class Uncached(object):
+    """common.addr_cache without the cache: every lookup parses."""
+
+    def network(self, cidr):
+        return addr_cache.AddressCache().network(cidr)
+
+    def address(self, address):
+        return addr_cache.AddressCache().address(address)
+
+    def is_ipv6(self, address):
+        return netaddr.valid_ipv6(address)
+
+
+def bench(num_ports):
+    cache = synthetic.network_cache([synthetic.network_dict(num_ports)])
+    network = cache.get_network_by_id(cache.get_network_ids()[0])
+    driver = synthetic.driver(network)
+    addresses = [fixed_ip.ip_address for port in network.ports
+                 for fixed_ip in port.fixed_ips]
+
+    def reload():
+        synthetic.reset_render_caches()
+        driver._render_config_files()
+
+    def format_addresses():
+        for address in addresses:
+            driver._format_address_for_dnsmasq(address)
+
+    def parse():
+        for address in addresses:
+            dhcp.addr_cache.address(address)
+
+    timings = []
+    for name in ('uncached', 'cached'):
+        dhcp.addr_cache = Uncached() if name == 'uncached' else addr_cache
+        timings.append((synthetic.best_of(reload),
+                        synthetic.best_of(format_addresses),
+                        synthetic.best_of(parse)))
+    dhcp.addr_cache = addr_cache
+
+    print('%d ports, %d fixed IPs, uncached -> cached:' %
+          (num_ports, len(addresses)))
+    for i, what in enumerate(('full reload', '_format_address_for_dnsmasq',
+                              'parse every fixed IP')):
+        print('  %-28s %7.1fms -> %6.1fms' % (
+            what, timings[0][i] * 1000, timings[1][i] * 1000))
+
+
+def main(argv):
+    num_ports = int(argv[1]) if len(argv) > 1 else 2000
+    confs_dir = synthetic.setup()
+    try:
+        bench(num_ports)
+    finally:
+        shutil.rmtree(confs_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
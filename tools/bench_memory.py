@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Measure the memory each network costs with Dnsmasq and SharedDnsmasq.
+
+    python tools/bench_memory.py [NETWORKS [PORTS]]
+
+NETWORKS networks (default 100) of PORTS ports each (default 20) are
+served both ways:
+
+agent       the growth of the agent's resident memory from making the
+            driver and process manager of every network and registering
+            them with a ProcessMonitor, measured in a child process per
+            driver so the two do not share an allocator.
+dnsmasq     the proportional set size of the dnsmasq processes serving
+            the networks, one per network or one for all of them.  Only
+            measured when dnsmasq is installed and this runs as root.
+
+The dnsmasq command lines are the ones the drivers build, with every
+interface replaced by lo, DNS off and a DHCP port of their own for each
+process so the per-network processes can run side by side outside of
+namespaces.
+"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import synthetic
+
+from oslo_config import cfg
+
+from nspagent.dhcp.linux import dhcp
+from nspagent.dhcp.linux import external_process
+
+DRIVERS = {'dnsmasq': 'Dnsmasq', 'shared': 'SharedDnsmasq'}
+# dnsmasq reads its hosts after forking, give it time before measuring
+SETTLE_TIME = 2
+FIRST_DHCP_PORT = 20067
+
+
+def memory_kb(pid='self'):
+    """Return the proportional set size of pid, or its RSS, in kB."""
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    with open('/proc/%s/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def network_cache(num_networks, num_ports):
+    return synthetic.network_cache(
+        synthetic.network_dict(num_ports, index, dual_stack=False)
+        for index in range(num_networks))
+
+
+def make_drivers(mode, cache):
+    """Return the drivers serving the cached networks, as the agent does."""
+    driver_cls = getattr(dhcp, DRIVERS[mode])
+    monitor = external_process.ProcessMonitor(config=cfg.CONF,
+                                              resource_type='dhcp')
+    drivers = []
+    for network_id in cache.get_network_ids():
+        driver = synthetic.driver(cache.get_network_by_id(network_id),
+                                  driver_cls, monitor)
+        pm = driver._get_process_manager(
+            cmd_callback=driver._build_cmdline_callback)
+        monitor.register(uuid=pm.uuid,
+                         service_name=dhcp.DNSMASQ_SERVICE_NAME,
+                         monitored_process=pm)
+        drivers.append(driver)
+    return monitor, drivers
+
+
+def agent_memory(mode, num_networks, num_ports):
+    """Return the agent memory growth of serving the networks, in kB."""
+    confs_dir = synthetic.setup()
+    try:
+        # the networks are the same in both modes, keep them out of it
+        cache = network_cache(num_networks, num_ports)
+        before = memory_kb()
+        monitor, drivers = make_drivers(mode, cache)
+        return memory_kb() - before
+    finally:
+        shutil.rmtree(confs_dir, ignore_errors=True)
+
+
+def dnsmasq_cmdlines(mode, drivers):
+    """Write the files of every network and return the command lines."""
+    cmdlines = []
+    for driver in drivers:
+        driver.interface_name = 'lo'
+        files, allocations = driver._render_config_files()
+        driver._output_init_lease_file(files)
+        driver._output_config_files(files)
+        if mode == 'shared':
+            driver.group.members[driver.network.id] = driver
+        else:
+            cmdlines.append(driver._build_cmdline_callback(
+                driver.get_conf_file_name('pid')))
+    if mode == 'shared':
+        group = drivers[0].group
+        cmdlines.append(group.build_cmdline(group.get_file_name('pid')))
+
+    standalone = []
+    for index, cmd in enumerate(cmdlines):
+        cmd = [arg for arg in cmd if arg != '--except-interface=lo' and
+               not arg.startswith('--interface=')]
+        port = FIRST_DHCP_PORT + 2 * index
+        cmd += ['--interface=lo', '--port=0',
+                '--dhcp-alternate-port=%d,%d' % (port, port + 1)]
+        standalone.append(cmd)
+    return standalone
+
+
+def dnsmasq_memory(mode, num_networks, num_ports):
+    """Return the memory of the dnsmasq processes serving the networks."""
+    confs_dir = synthetic.setup()
+    pids = []
+    try:
+        monitor, drivers = make_drivers(
+            mode, network_cache(num_networks, num_ports))
+        for cmd in dnsmasq_cmdlines(mode, drivers):
+            pid_file = [arg.split('=', 1)[1] for arg in cmd
+                        if arg.startswith('--pid-file=')][0]
+            subprocess.check_call(cmd)
+            with open(pid_file) as f:
+                pids.append(int(f.read()))
+        time.sleep(SETTLE_TIME)
+        return sum(memory_kb(pid) for pid in pids), len(pids)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        shutil.rmtree(confs_dir, ignore_errors=True)
+
+
+def have_dnsmasq():
+    if os.geteuid() != 0:
+        return False
+    try:
+        subprocess.check_output(['dnsmasq', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def main(argv):
+    if len(argv) == 5 and argv[1] == '--agent':
+        print(agent_memory(argv[2], int(argv[3]), int(argv[4])))
+        return 0
+    num_networks = int(argv[1]) if len(argv) > 1 else 100
+    num_ports = int(argv[2]) if len(argv) > 2 else 20
+    print('%d networks of %d ports, memory per network:' %
+          (num_networks, num_ports))
+
+    for mode in sorted(DRIVERS):
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--agent', mode,
+             str(num_networks), str(num_ports)])
+        print('  agent    %-8s %8.1f kB' %
+              (mode, float(out.split()[-1]) / num_networks))
+
+    if not have_dnsmasq():
+        print('  dnsmasq  not measured, needs root and dnsmasq')
+        return 0
+    for mode in sorted(DRIVERS):
+        total, processes = dnsmasq_memory(mode, num_networks, num_ports)
+        print('  dnsmasq  %-8s %8.1f kB  (%d processes, %d kB)' %
+              (mode, float(total) / num_networks, processes, total))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Time the rendering of the dnsmasq files of one network on a reload.
+
+    python tools/bench_render.py [PORTS ...]
+
+For every port count (default 1000 10000 50000) a dual-stack network is
+put in an agent NetworkCache and its Dnsmasq driver renders the host,
+addn_hosts, opts and leases files, first with the per-port caches empty,
+as after an agent restart, then again with nothing changed and after a
+single port update.  'write' also replaces the files on disk.  Times are
+the best CPU time of a few runs.
+"""
+
+import shutil
+import sys
+
+import synthetic
+
+from nspagent.dhcp.linux import dhcp
+
+
+def bench(num_ports, repeat):
+    cache = synthetic.network_cache([synthetic.network_dict(num_ports)])
+    network = cache.get_network_by_id(cache.get_network_ids()[0])
+    driver = synthetic.driver(network)
+
+    def cold_render():
+        synthetic.reset_render_caches()
+        driver._render_config_files()
+
+    def cold_write():
+        synthetic.reset_render_caches()
+        driver._output_config_files(driver._render_config_files()[0])
+
+    def warm_render():
+        driver._render_config_files()
+
+    cold = synthetic.best_of(cold_render, repeat)
+    write = synthetic.best_of(cold_write, repeat)
+    warm = synthetic.best_of(warm_render, repeat)
+
+    port = network.ports[len(network.ports) // 2].to_dict()
+    port['extra_dhcp_opts'] = [{'opt_name': 'bootfile-name',
+                                'opt_value': 'changed', 'ip_version': 4}]
+
+    def one_port():
+        cache.put_port(dhcp.PortModel(port))
+        driver.network = cache.get_network_by_id(network.id)
+        driver._render_config_files()
+
+    changed = synthetic.best_of(one_port, repeat)
+    print('%6d ports: cold %.3fs  write %.3fs  unchanged %.3fs  '
+          '1 port changed %.3fs' % (num_ports, cold, write, warm, changed))
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv[1:]] or [1000, 10000, 50000]
+    confs_dir = synthetic.setup(dnsmasq_use_hostsdir=False)
+    try:
+        for num_ports in counts:
+            bench(num_ports, 3 if num_ports > 10000 else 5)
+    finally:
+        shutil.rmtree(confs_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
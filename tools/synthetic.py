@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Synthetic networks for the benchmarks in this directory.
+
+The networks look like the bodies the API receives: an IPv4 subnet with
+DHCP, an IPv4 subnet without, a DHCPv6 stateless and a DHCPv6 stateful
+subnet, one DHCP port and compute ports spread over the subnets, by
+default every fourth of them with extra DHCP options.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from oslo_config import cfg
+
+from common import config
+import logger
+
+INTERFACE_DRIVER = 'nspagent.dhcp.linux.interface.OVSInterfaceDriver'
+
+
+def setup(confs_dir=None, **overrides):
+    """Register the agent options and point them at a scratch directory.
+
+    Returns the directory dnsmasq files are written to.
+    """
+    config.register_conf()
+    confs_dir = confs_dir or tempfile.mkdtemp(prefix='dhcp-bench-')
+    cfg.CONF.set_override('dhcp_confs', confs_dir)
+    cfg.CONF.set_override('external_pids', os.path.join(confs_dir, 'pids'))
+    cfg.CONF.set_override('interface_driver', INTERFACE_DRIVER)
+    cfg.CONF.set_override('check_child_processes_interval', 0, 'AGENT')
+    for name, value in overrides.items():
+        cfg.CONF.set_override(name, value)
+    logger.log.setLevel(logging.WARNING)
+    return confs_dir
+
+
+def network_dict(num_ports, index=0, extra_opts=3, dual_stack=True,
+                 opts_every=4):
+    """Return the body of a network with num_ports compute ports.
+
+    Networks of different index have different ids, CIDRs and MACs, so
+    they can be served side by side.  Every opts_every-th port has
+    extra_opts extra DHCP options.
+    """
+    network_id = str(uuid.UUID(int=index + 1))
+    # 10.0.0.0/16, 10.1.0.0/16, ... 11.0.0.0/16 and so on
+    v4_prefix = '%d.%d' % (10 + index // 256, index % 256)
+    nodhcp_prefix = '%d.%d' % (100 + index // 256, index % 256)
+
+    def subnet(name, cidr, ip_version, enable_dhcp=True, **kwargs):
+        body = {'id': '%s-%s' % (name, network_id), 'network_id': network_id,
+                'cidr': cidr, 'ip_version': ip_version,
+                'enable_dhcp': enable_dhcp, 'gateway_ip': None,
+                'dns_nameservers': [], 'host_routes': [],
+                'ipv6_address_mode': None, 'ipv6_ra_mode': None}
+        body.update(kwargs)
+        return body
+
+    v4 = subnet('v4', '%s.0.0/16' % v4_prefix, 4,
+                gateway_ip='%s.0.1' % v4_prefix,
+                host_routes=[{'destination': '0.0.0.0/0',
+                              'nexthop': '%s.0.2' % v4_prefix}])
+    subnets = [v4,
+               subnet('v4-nodhcp', '%s.0.0/16' % nodhcp_prefix, 4,
+                      enable_dhcp=False, dns_nameservers=['8.8.8.8'])]
+    if dual_stack:
+        subnets += [
+            subnet('v6-stateless', 'fd00:%x::/64' % index, 6,
+                   gateway_ip='fd00:%x::1' % index,
+                   ipv6_address_mode='dhcpv6-stateless'),
+            subnet('v6-stateful', 'fd01:%x::/64' % index, 6,
+                   gateway_ip='fd01:%x::1' % index,
+                   ipv6_address_mode='dhcpv6-stateful')]
+
+    def port(i, owner, fixed_ips, opts=()):
+        mac = 'fa:%02x:%02x:%02x:%02x:%02x' % (
+            index >> 8 & 255, index & 255, i >> 16 & 255, i >> 8 & 255,
+            i & 255)
+        return {'id': 'port-%d-%s' % (i, network_id),
+                'network_id': network_id, 'mac_address': mac,
+                'admin_state_up': True, 'device_owner': owner,
+                'device_id': 'vm-%d' % i, 'fixed_ips': fixed_ips,
+                'extra_dhcp_opts': list(opts)}
+
+    ports = [port(0, 'network:dhcp',
+                  [{'subnet_id': v4['id'],
+                    'ip_address': '%s.0.3' % v4_prefix}])]
+    options = [{'opt_name': 'bootfile-name', 'opt_value': 'pxelinux.0',
+                'ip_version': 4},
+               {'opt_name': 'tag:ipxe,tftp-server', 'opt_value': '10.0.0.9',
+                'ip_version': 4},
+               {'opt_name': 'dns-server', 'opt_value': '[fd00::9]',
+                'ip_version': 6}]
+    options += [{'opt_name': '%d' % (224 + n),
+                 'opt_value': 'value-%d' % n, 'ip_version': 4}
+                for n in range(max(extra_opts - len(options), 0))]
+    for i in range(1, num_ports + 1):
+        fixed_ips = [{'subnet_id': v4['id'],
+                      'ip_address': '%s.%d.%d' % (v4_prefix, (i + 9) >> 8,
+                                                  (i + 9) & 255)}]
+        if dual_stack and i % 3 == 0:
+            fixed_ips.insert(0, {'subnet_id': subnets[2]['id'],
+                                 'ip_address': 'fd00:%x::%x' % (index, i)})
+        if i % 5 == 0:
+            fixed_ips.append({'subnet_id': subnets[1]['id'],
+                              'ip_address': '%s.%d.%d' % (nodhcp_prefix,
+                                                          i >> 8, i & 255)})
+        if dual_stack and i % 7 == 0:
+            fixed_ips.append({'subnet_id': subnets[3]['id'],
+                              'ip_address': 'fd01:%x::%x' % (index, i)})
+        opts = options[:extra_opts] if i % opts_every == 0 else ()
+        ports.append(port(i, 'compute:nova', fixed_ips, opts))
+
+    return {'id': network_id, 'admin_state_up': True, 'mtu': 1450,
+            'interfacename': 'tap%s' % network_id[-8:],
+            'subnets': subnets, 'ports': ports}
+
+
+def network_cache(networks):
+    """Return an agent NetworkCache holding the network bodies.
+
+    The cache tells the Dnsmasq caches about its changes, as the agent
+    has it do.
+    """
+    from nspagent.dhcp import agent
+    from nspagent.dhcp.linux import dhcp
+
+    cache = agent.NetworkCache()
+    cache.add_listener(dhcp.Dnsmasq.get_cache_listener())
+    for body in networks:
+        cache.put(dhcp.NetModel(cfg.CONF.use_namespaces, body))
+    return cache
+
+
+def driver(network, driver_cls=None, process_monitor=None,
+           version=(2, 80)):
+    """Return a DHCP driver for a cached network, as the agent makes it."""
+    from nspagent.dhcp.linux import dhcp
+
+    driver_cls = driver_cls or dhcp.Dnsmasq
+    return driver_cls(cfg.CONF, network, process_monitor, version)
+
+
+def reset_render_caches():
+    """Forget what was rendered, as after an agent restart."""
+    from nspagent.dhcp.linux import dhcp
+
+    dhcp.port_fragments = dhcp.PortFragmentCache()
+    dhcp.subnet_options = dhcp.SubnetOptionCache()
+    dhcp.config_digests.clear()
+    dhcp.port_file_state.clear()
+
+
+def best_of(func, repeat=5):
+    """Return the lowest CPU time of repeat calls of func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.clock()
+        func()
+        elapsed = time.clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best